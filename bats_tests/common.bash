@@ -46,3 +46,13 @@ create_vapp() {
 delete_vapp() {
     "$VAPPRUN" delete "$1"
 }
+
+use_fake_vmrun() {
+    export PATH="$BATS_TEST_DIRNAME/fake-vmrun:$PATH"
+    export FAKE_VMRUN_STATE="$VAPPRUN_WORKSPACE/fake-vmrun.state"
+    export FAKE_VMRUN_LOG="$VAPPRUN_WORKSPACE/fake-vmrun.log"
+}
+
+create_sim_vm() {
+    VAPPRUN_BACKEND=simulator "$VAPPRUN" create-vm "$1" 2>/dev/null
+}
@@ -0,0 +1,70 @@
+#!/usr/bin/env bats
+#
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+load common
+
+setup() {
+    init_workspace
+}
+
+teardown() {
+    delete_workspace
+}
+
+@test "IP range of a CIDR network" {
+    run "$VAPPRUN" workspace range=10.20.60.0/29
+    [ "$status" -eq 0 ]
+    [[ "$output" =~ "Free IP addreses (6)" ]]
+    [[ "$output" =~ "10.20.60.1-10.20.60.6" ]]
+}
+
+@test "IP range of several ranges" {
+    run "$VAPPRUN" workspace range=10.0.0.1#2,10.0.0.10-10.0.0.11,10.0.0.20
+    [ "$status" -eq 0 ]
+    [[ "$output" =~ "Free IP addreses (5)" ]]
+    [[ "$output" =~ "10.0.0.1-10.0.0.2, 10.0.0.10-10.0.0.11, 10.0.0.20" ]]
+}
+
+@test "Overlapping and adjacent IP ranges are merged" {
+    run "$VAPPRUN" workspace range=10.0.0.1#4,10.0.0.3-10.0.0.6,10.0.0.7
+    [ "$status" -eq 0 ]
+    [[ "$output" =~ "Free IP addreses (7)" ]]
+    [[ "$output" =~ "10.0.0.1-10.0.0.7" ]]
+    [[ ! "$output" =~ "10.0.0.1-10.0.0.7," ]]
+}
+
+@test "Invalid IP range is rejected" {
+    run "$VAPPRUN" workspace range=10.0.0.9-10.0.0.1
+    [ "$status" -eq 1 ]
+    [[ "$output" =~ "Error: Invalid IP range" ]]
+}
+
+@test "IP range larger than a /16 is rejected" {
+    "$VAPPRUN" workspace range=10.0.0.0/16
+    run "$VAPPRUN" workspace range=10.0.0.0/8
+    [ "$status" -eq 1 ]
+    [[ "$output" =~ "Error: IP range too large" ]]
+    run "$VAPPRUN" workspace -q
+    [[ "$output" =~ "range = 10.0.0.0/16" ]]
+}
+
+@test "Too large IP range in the workspace can be replaced" {
+    sed -i 's|<range>.*</range>|<range>0.0.0.0/1</range>|' vapprun.cfg
+    run "$VAPPRUN" workspace range=10.0.0.1#2
+    [ "$status" -eq 0 ]
+    [[ "$output" =~ "Error: IP range too large" ]]
+    [[ "$output" =~ "10.0.0.1-10.0.0.2" ]]
+}
@@ -155,3 +155,74 @@ teardown() {
     run "$VAPPRUN" list
     [[ ${lines[0]} = "Empty workspace" ]]
 }
+
+# Inventory snapshot tests
+
+@test "Check vapp.cfg edited after the snapshot was written" {
+    create_vapp foo
+    "$VAPPRUN" def-property foo key=plop type=string value=bar
+    "$VAPPRUN" list
+    [ -e "$VAPPRUN_WORKSPACE"/.cache/inventory ]
+    # Same size, and the modification time is put back
+    cp -p foo/vapp.cfg vapp.cfg.orig
+    sed -i 's/value="bar"/value="baz"/' foo/vapp.cfg
+    touch -r vapp.cfg.orig foo/vapp.cfg
+    "$VAPPRUN" list -q foo | grep plop | {
+            run awk '{print $1, $2, $3}'
+            [[ ${lines[0]} = "plop string baz" ]]
+        }
+    "$VAPPRUN" list
+    "$VAPPRUN" list -q foo | grep -q "plop  *string  *baz"
+}
+
+@test "Check vapps added and removed after the snapshot was written" {
+    create_vapp foo
+    "$VAPPRUN" list
+    cp -r foo bar
+    run "$VAPPRUN" list -q
+    [[ "$output" =~ bar\ +vApp ]]
+    rm -rf foo
+    run "$VAPPRUN" list -q
+    [[ ! "$output" =~ foo\ +vApp ]]
+    [[ "$output" =~ bar\ +vApp ]]
+}
+
+@test "Check list leaves the workspace files untouched" {
+    create_vapp foo
+    "$VAPPRUN" def-property foo key=plop type=string value=bar
+    "$VAPPRUN" list
+    before=$(find . -printf '%p %T@\n' | sort)
+    "$VAPPRUN" list
+    "$VAPPRUN" list -q foo
+    [ "$before" = "$(find . -printf '%p %T@\n' | sort)" ]
+}
+
+@test "Check a broken vapp does not affect commands on another one" {
+    create_vapp foo
+    create_vapp bar
+    "$VAPPRUN" list
+    echo "<vApp" > bar/vapp.cfg
+    run "$VAPPRUN" list
+    [ "$status" -ne 0 ]
+    run "$VAPPRUN" list foo
+    [ "$status" -eq 0 ]
+    [[ ${lines[0]} =~ Name.*foo ]]
+}
+
+@test "Check read-only commands leave deploy.cfg untouched" {
+    create_vapp foo
+    "$VAPPRUN" def-property foo key=plop type=string value=bar
+    "$VAPPRUN" edit foo 'appUrl=http://${plop}/'
+    "$VAPPRUN" list
+    [ -e foo/deploy.cfg ]
+    before=$(stat -c '%i %Y %s' foo/deploy.cfg)
+    cp foo/deploy.cfg deploy.cfg.orig
+    sleep 1
+    run "$VAPPRUN" list
+    [[ "$output" =~ "http://bar/" ]]
+    "$VAPPRUN" list foo
+    "$VAPPRUN" workspace
+    "$VAPPRUN" start -n foo
+    [ "$before" = "$(stat -c '%i %Y %s' foo/deploy.cfg)" ]
+    cmp foo/deploy.cfg deploy.cfg.orig
+}
@@ -0,0 +1,226 @@
+#!/usr/bin/env bats
+#
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+load common
+
+setup() {
+    init_workspace
+    export VAPPRUN_BACKEND=simulator
+    export VAPPRUN_SIM_STATE="$VAPPRUN_WORKSPACE/simulator.json"
+    export VAPPRUN_SIM_BOOT_TIME=0
+}
+
+teardown() {
+    delete_workspace
+}
+
+@test "Start and stop a VM with the simulator backend" {
+    create_vm vm1
+    run "$VAPPRUN" start vm1
+    [ "$status" -eq 0 ]
+    run "$VAPPRUN" list
+    [[ "$output" =~ vm1\ +VM\ +Powered\ On ]]
+    run "$VAPPRUN" stop vm1
+    [ "$status" -eq 0 ]
+    run "$VAPPRUN" list
+    [[ "$output" =~ vm1\ +VM\ +Powered\ Off ]]
+}
+
+@test "Delete a VM to the trash and purge it" {
+    create_vm vm1
+    echo "notes" > vm1/notes.txt
+    run "$VAPPRUN" delete -t vm1
+    [ "$status" -eq 0 ]
+    [ ! -e vm1/vm.cfg -a ! -e vm1/vmx ]
+    [ "$(cat vm1/notes.txt)" = "notes" ]
+    run "$VAPPRUN" gc
+    [ "$status" -eq 0 ]
+    [ -z "$(ls .trash)" ]
+    [ "$(cat vm1/notes.txt)" = "notes" ]
+    run "$VAPPRUN" list
+    [[ ${lines[0]} = "Empty workspace" ]]
+}
+
+@test "Purge the trash of a workspace with an invalid configuration" {
+    create_vm vm1
+    "$VAPPRUN" delete -t vm1
+    mkdir broken
+    echo "not xml" > broken/vm.cfg
+    run "$VAPPRUN" gc
+    [ "$status" -eq 0 ]
+    [ -z "$(ls .trash)" ]
+}
+
+@test "An unchanged .vmx file is written back byte for byte" {
+    printf '.encoding = "UTF-8"\r\n# A comment = with an equal sign\r\n\r\n' \
+        > test.vmx
+    printf '  MemSize   =   "256"\r\ndisplayName = "a |22name|22"' >> test.vmx
+    cp test.vmx orig.vmx
+    run python -c 'import sys
+from vmw.vapprun.vmrun import VmxDocument
+doc = VmxDocument(sys.argv[1])
+sys.exit(doc.serialize() != open(sys.argv[2], "rb").read().decode() or
+         doc.save())' test.vmx orig.vmx
+    [ "$status" -eq 0 ]
+    cmp test.vmx orig.vmx
+    [ ! -e test.vmx.old ]
+}
+
+@test "Starting a VM keeps the formatting of its .vmx file" {
+    mkdir ext
+    printf '.encoding = "UTF-8"\r\n# Hand-written, keep this comment\r\n' \
+        > ext/vm.vmx
+    printf 'MemSize   =   "256"\r\nide1:0.present = "TRUE"\r\n' >> ext/vm.vmx
+    printf 'ide1:0.deviceType = "cdrom-raw"\r\n' >> ext/vm.vmx
+    "$VAPPRUN" link-vm vm1 vmx="$VAPPRUN_WORKSPACE/ext/vm.vmx"
+    "$VAPPRUN" start vm1
+    "$VAPPRUN" stop vm1
+    grep -qx $'# Hand-written, keep this comment\r' ext/vm.vmx
+    grep -qx $'MemSize   =   "256"\r' ext/vm.vmx
+    grep -qx $'ide1:0.deviceType = "cdrom-image"\r' ext/vm.vmx
+    # Every line keeps the CRLF line end
+    [ -z "$(grep -v $'\r$' ext/vm.vmx)" ]
+    # A second start and stop leaves the file as it is
+    cp ext/vm.vmx stopped.vmx
+    "$VAPPRUN" start vm1
+    "$VAPPRUN" stop vm1
+    cmp ext/vm.vmx stopped.vmx
+}
+
+@test "The OVF environment ISO lists its file in all three name formats" {
+    command -v bsdtar || skip "bsdtar is not installed"
+    create_vm vm1
+    "$VAPPRUN" def-property vm1 key=greeting type=string value=hello
+    "$VAPPRUN" start vm1
+    ISO=vm1/vmx/ovf-env.iso
+    # Rock Ridge, Joliet and plain ISO9660 names
+    [[ "$(bsdtar -tf $ISO)" =~ ovf-env.xml ]]
+    [[ "$(bsdtar --options 'iso9660:!rockridge' -tf $ISO)" =~ ovf-env.xml ]]
+    [[ "$(bsdtar --options 'iso9660:!rockridge,iso9660:!joliet' -tf $ISO)" \
+        =~ OVF_ENV.XML ]]
+    [ "$(dd if=$ISO bs=1 skip=32808 count=7 2>/dev/null)" = "OVF ENV" ]
+    bsdtar -xOf $ISO ovf-env.xml | \
+        grep -q '<Property oe:key="greeting" oe:value="hello"/>'
+}
+
+@test "A vApp whose VM fails to power on releases its IPs" {
+    create_vapp app
+    create_vm vm1
+    create_vm vm2
+    "$VAPPRUN" edit vm1 parent=app
+    "$VAPPRUN" edit vm2 parent=app
+    "$VAPPRUN" edit vm1 startOrder=10
+    "$VAPPRUN" edit vm2 startOrder=20
+    "$VAPPRUN" def-property app key=ip type=ip:Network
+    "$VAPPRUN" set-property -transient app
+    VAPPRUN_SIM_FAILURE_RATE=1 run "$VAPPRUN" start app
+    [ "$status" -eq 1 ]
+    [[ "$output" =~ "Error: Failed to power on vm1" ]]
+    [[ "$output" =~ "Error: Not starting the rest of app" ]]
+    [[ ! "$output" =~ "Starting vm2" ]]
+    [[ ! "$(cat leases.cfg)" =~ "<lease " ]]
+    run "$VAPPRUN" list
+    [[ "$output" =~ vm1\ +VM\ +Powered\ Off ]]
+}
+
+@test "The VMs of a tier start and stop together, escalating after stopWait" {
+    create_vapp app
+    for vm in vm1 vm2 vm3; do
+        create_vm $vm
+        "$VAPPRUN" edit $vm parent=app
+        "$VAPPRUN" edit $vm startOrder=10 startWait=10 waitForTools=true \
+            stopWait=2
+    done
+    # One after the other, each tier would take three times as long
+    SECONDS=0
+    VAPPRUN_SIM_BOOT_TIME=2 run "$VAPPRUN" start app
+    [ "$status" -eq 0 ]
+    [ $SECONDS -lt 5 ]
+    run "$VAPPRUN" list
+    [ $(echo "$output" | grep -c "VM  *Powered On") -eq 3 ]
+    SECONDS=0
+    VAPPRUN_SIM_STOP_TIME=30 run "$VAPPRUN" stop app
+    [ "$status" -eq 0 ]
+    [ $SECONDS -lt 5 ]
+    for vm in vm1 vm2 vm3; do
+        [[ "$output" =~ "$vm did not stop within 2 secs, powering off" ]]
+    done
+    run "$VAPPRUN" list
+    [ $(echo "$output" | grep -c "VM  *Powered Off") -eq 3 ]
+}
+
+@test "Concurrent starts lease different IPs" {
+    "$VAPPRUN" workspace range=10.0.0.1#4
+    for vm in vm1 vm2 vm3 vm4; do
+        create_vm $vm
+        "$VAPPRUN" def-property $vm key=ip type=ip:Network
+        "$VAPPRUN" set-property -transient $vm
+    done
+    for vm in vm1 vm2 vm3 vm4; do
+        "$VAPPRUN" start $vm > $vm.out &
+    done
+    wait
+    [ $(grep -c "<lease " leases.cfg) -eq 4 ]
+    [ $(grep -o 'ip="[^"]*"' leases.cfg | sort -u | wc -l) -eq 4 ]
+    # Every VM got the IP leased to it
+    for vm in vm1 vm2 vm3 vm4; do
+        ip=$(sed -n "s/.*entity=\"$vm\" key=\"ip\" ip=\"\([^\"]*\)\".*/\1/p" \
+            leases.cfg)
+        "$VAPPRUN" list -q $vm | grep -q "ip  *$ip *$"
+    done
+}
+
+@test "An OVF environment seen before reuses its cached ISO" {
+    create_vm vm1
+    "$VAPPRUN" def-property vm1 key=greeting type=string value=hello
+    "$VAPPRUN" start vm1
+    "$VAPPRUN" stop vm1
+    inode=$(stat -c %i vm1/vmx/ovf-env.iso)
+    [ $(ls .cache/ovfenv | wc -l) -eq 1 ]
+    "$VAPPRUN" set-property vm1 greeting=bye
+    "$VAPPRUN" start vm1
+    "$VAPPRUN" stop vm1
+    [ $(stat -c %i vm1/vmx/ovf-env.iso) -ne $inode ]
+    [ $(ls .cache/ovfenv | wc -l) -eq 2 ]
+    # Back to the first environment: the image is linked, not rebuilt
+    "$VAPPRUN" set-property vm1 greeting=hello
+    "$VAPPRUN" start vm1
+    [ $(stat -c %i vm1/vmx/ovf-env.iso) -eq $inode ]
+    [ $(ls .cache/ovfenv | wc -l) -eq 2 ]
+    grep -q 'oe:key="greeting" oe:value="hello"' vm1/vmx/ovf-env.xml
+}
+
+@test "An undefined reference is reported before any VM is powered on" {
+    create_vapp app
+    create_vapp sub
+    create_vm vm1
+    create_vm vm2
+    "$VAPPRUN" edit vm1 parent=app
+    "$VAPPRUN" edit sub parent=app
+    "$VAPPRUN" edit vm2 parent=sub
+    "$VAPPRUN" edit vm1 startOrder=10
+    "$VAPPRUN" edit sub startOrder=20
+    # Only a VM of the nested vApp, started last, uses the reference
+    "$VAPPRUN" def-property vm2 key=x type=expression 'value=${nope}'
+    run "$VAPPRUN" start app
+    [ "$status" -eq 1 ]
+    [[ "$output" =~ "Error: Undefined reference 'nope' for property 'x'" ]]
+    [[ ! "$output" =~ "Starting vm1" ]]
+    [ ! -e simulator.json ] || [[ ! "$(cat simulator.json)" =~ vm.vmx ]]
+    run "$VAPPRUN" list
+    [[ "$output" =~ vm1\ +VM\ +Powered\ Off ]]
+    [[ "$output" =~ vm2\ +VM\ +Powered\ Off ]]
+}
@@ -0,0 +1,73 @@
+#!/usr/bin/env bats
+#
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+load common
+
+# These tests run the vmrun backend against bats_tests/fake-vmrun/vmrun
+
+setup() {
+    init_workspace
+    use_fake_vmrun
+    create_sim_vm vm1
+    "$VAPPRUN" def-property vm1 key=ip type=ip:Network
+    "$VAPPRUN" set-property -transient vm1
+}
+
+teardown() {
+    delete_workspace
+}
+
+@test "A VM whose soft stop fails is powered off" {
+    "$VAPPRUN" start vm1
+    FAKE_VMRUN_NO_TOOLS=1 run "$VAPPRUN" stop vm1
+    [[ "$output" =~ "vm1 failed to stop, powering off" ]]
+    [[ "$output" =~ "(vm1 stopped in" ]]
+    grep -q "^stop .*/vm1/vmx/vm.vmx hard$" "$FAKE_VMRUN_LOG"
+    [ ! -s "$FAKE_VMRUN_STATE" ]
+    [[ ! "$(cat leases.cfg)" =~ "<lease " ]]
+}
+
+@test "A VM that fails to stop keeps its IP lease and OVF environment" {
+    "$VAPPRUN" start vm1
+    FAKE_VMRUN_FAIL_STOP=1 run "$VAPPRUN" stop vm1
+    [[ "$output" =~ "Error: Failed to stop vm1" ]]
+    [[ ! "$output" =~ "stopped in" ]]
+    grep -q '<lease entity="vm1" key="ip"' leases.cfg
+    grep -qx 'ide1:0.startConnected = "TRUE"' vm1/vmx/vm.vmx
+    run "$VAPPRUN" list
+    [[ "$output" =~ vm1\ +VM\ +Powered\ On ]]
+}
+
+@test "Power states are probed without guest IPs where none are needed" {
+    "$VAPPRUN" start vm1
+    : > "$FAKE_VMRUN_LOG"
+    run "$VAPPRUN" delete vm1
+    [[ "$output" =~ "Error: entity is running" ]]
+    run "$VAPPRUN" workspace -r
+    [ "$status" -eq 0 ]
+    grep -q "^list$" "$FAKE_VMRUN_LOG"
+    [ -z "$(grep "^readVariable" "$FAKE_VMRUN_LOG")" ]
+    # list shows the IP, so it reads it
+    "$VAPPRUN" list
+    grep -q "^readVariable .* guestinfo.ip$" "$FAKE_VMRUN_LOG"
+}
+
+@test "A VM that fails to power on is reported and releases its IP" {
+    FAKE_VMRUN_FAIL_START=1 run "$VAPPRUN" start vm1
+    [ "$status" -eq 1 ]
+    [[ "$output" =~ "Error: Failed to power on vm1" ]]
+    [[ ! "$(cat leases.cfg)" =~ "<lease " ]]
+}
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures loading a large workspace.
+
+Usage: bench_inventory.py [entities [properties]]
+
+A synthetic workspace of vApps with 9 VMs each is created in a
+temporary directory. It is loaded with and without the inventory
+snapshot, and the load time and the memory held by the inventory
+(measured with tracemalloc) are printed.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from vmw.vapprun.utils import NewXmlNode  # noqa: E402
+from vmw.vapprun.vapps import (VAPP_CFG_NAME, VM_CFG_NAME,  # noqa: E402
+                               VAppInventory, createNewWorkspace)
+
+
+def WriteEntity(wsDir, name, tag, cfgName, parent, properties):
+    node = NewXmlNode(tag)
+    if tag == "vm":
+        node.setAttr("transport", "iso com.vmware.guestInfo")
+        node.addChild(NewXmlNode("vmx").setAttr("file", "vmx/vm.vmx"))
+    if parent is not None:
+        node.addChild(NewXmlNode("link")
+                      .setAttr("name", parent)
+                      .setAttr("startOrder", 30)
+                      .setAttr("startWait", 30)
+                      .setAttr("stopWait", 30)
+                      .setAttr("waitForTools", "true"))
+    for i in range(properties):
+        node.addChild(NewXmlNode("property")
+                      .setAttr("key", "%s_key%d" % (name, i))
+                      .setAttr("type", "expression")
+                      .setAttr("value", "http://${ip}:%d/" % i)
+                      .setAttr("userConfigurable", "false"))
+    os.mkdir(os.path.join(wsDir, name))
+    node.writeToFile(os.path.join(wsDir, name, cfgName), syncDir=False)
+
+
+def CreateWorkspace(wsDir, entities, properties):
+    cwd = os.getcwd()
+    os.chdir(wsDir)
+    try:
+        createNewWorkspace()
+    finally:
+        os.chdir(cwd)
+
+    for v in range((entities + 9) // 10):
+        vapp = "vapp%d" % v
+        WriteEntity(wsDir, vapp, "vapp", VAPP_CFG_NAME, None, properties)
+        for i in range(min(9, entities - 10 * v - 1)):
+            WriteEntity(wsDir, "vm%d_%d" % (v, i), "vm", VM_CFG_NAME, vapp,
+                        properties)
+
+
+def Measure(name, wsDir, entities):
+    gc.collect()
+    start = time.time()
+    VAppInventory(wsDir)
+    secs = time.time() - start
+
+    # Tracing slows the load down, so it is measured separately
+    gc.collect()
+    tracemalloc.start()
+    vapps = VAppInventory(wsDir)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if len(vapps.entities) != entities:
+        print("Error: Loaded", len(vapps.entities), "entities")
+        sys.exit(1)
+    print("%-14s %7.2f s %7.1f MB held %7.1f MB peak" %
+          (name, secs, current / 1e6, peak / 1e6))
+
+
+def main():
+    entities = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    properties = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+    wsDir = tempfile.mkdtemp(prefix="vapprun-bench-")
+    try:
+        CreateWorkspace(wsDir, entities, properties)
+        print("Workspace: %d entities, %d properties each" %
+              (entities, properties))
+
+        os.environ["VAPPRUN_INVENTORY_CACHE"] = "0"
+        Measure("parse all", wsDir, entities)
+        del os.environ["VAPPRUN_INVENTORY_CACHE"]
+
+        VAppInventory(wsDir)  # Creates the snapshot
+        Measure("from snapshot", wsDir, entities)
+    finally:
+        shutil.rmtree(wsDir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the XmlNode codec with the minidom based one it replaced.
+
+Usage: bench_xml.py [properties [rounds]]
+
+A vApp configuration with the given number of properties is parsed and
+serialized repeatedly by both codecs, and the throughput is printed.
+The minidom code is kept here only as the reference.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import io
+import os
+import sys
+import timeit
+import xml.dom.minidom
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from six import StringIO  # noqa: E402
+
+from vmw.vapprun.utils import NewXmlNode, ParseXml, XmlNode  # noqa: E402
+
+
+def MinidomRead(data):
+    doc = xml.dom.minidom.parse(io.BytesIO(data))
+    node = MinidomReadElement(doc.documentElement)
+    doc.unlink()
+    return node
+
+
+def MinidomReadElement(elem):
+    attrs = {}
+    children = []
+    value = None
+
+    for i in range(0, elem.attributes.length):
+        a = elem.attributes.item(i)
+        attrs[a.name] = a.value
+
+    for c in elem.childNodes:
+        if c.nodeType == elem.ELEMENT_NODE:
+            children.append(MinidomReadElement(c))
+        elif c.nodeType == elem.TEXT_NODE:
+            value = c.data
+
+    return XmlNode(elem.tagName, attrs, value, children)
+
+
+def MinidomWrite(node):
+    impl = xml.dom.minidom.getDOMImplementation()
+    doc = impl.createDocument(None, node.tag, None)
+    MinidomWriteElement(node, doc, doc.documentElement)
+    f = StringIO()
+    doc.writexml(writer=f, addindent="  ", newl="\n")
+    doc.unlink()
+    return f.getvalue()
+
+
+def MinidomWriteElement(node, doc, elem):
+    for key, value in node.attrs.items():
+        elem.setAttribute(key, str(value))
+
+    if node.value is not None:
+        elem.appendChild(doc.createTextNode(str(node.value).strip()))
+
+    for cn in node.children:
+        en = doc.createElement(cn.tag)
+        MinidomWriteElement(cn, doc, en)
+        elem.appendChild(en)
+
+
+def CreateConfig(properties):
+    node = NewXmlNode("vapp")
+    node.setAttr("appUrl", "http://${ip}:8080/")
+    node.addChild(NewXmlNode("link").setAttr("name", "parent"))
+    for i in range(properties):
+        p = NewXmlNode("property")
+        p.setAttr("key", "key%d" % i)
+        p.setAttr("type", "expression")
+        p.setAttr("value", "${ip}:%d & <more>" % i)
+        p.setAttr("userConfigurable", "false")
+        node.addChild(p)
+    node.addXmlTextNode("transport", "iso")
+    return node
+
+
+def Measure(name, func, rounds, size):
+    secs = min(timeit.repeat(func, number=rounds, repeat=3))
+    print("%-18s %8.2f ms %8.1f MB/s" %
+          (name, 1000 * secs / rounds, size * rounds / secs / 1e6))
+
+
+def main():
+    properties = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    node = CreateConfig(properties)
+    text = node.toXmlString()
+    data = text.encode("utf-8")
+    if MinidomWrite(node) != text:
+        print("Error: The codecs write different documents")
+        sys.exit(1)
+    if MinidomRead(data).snapshot() != ParseXml(io.BytesIO(data)).snapshot():
+        print("Error: The codecs read different trees")
+        sys.exit(1)
+
+    print("Document: %d properties, %d bytes" % (properties, len(data)))
+    Measure("parse minidom", lambda: MinidomRead(data), rounds, len(data))
+    Measure("parse etree", lambda: ParseXml(io.BytesIO(data)),
+            rounds, len(data))
+    Measure("write minidom", lambda: MinidomWrite(node), rounds, len(data))
+    Measure("write streaming", node.toXmlString, rounds, len(data))
+
+
+if __name__ == "__main__":
+    main()
@@ -12,5 +12,7 @@ setup(
     package_data={'vmw.vapprun': ['templates/*']},
     scripts=['bin/vapprun'],
     setup_requires=['setuptools'],
-    install_requires=['setuptools', 'six>=1.10.0'],
+    install_requires=['setuptools', 'six>=1.10.0',
+                      'ipaddress; python_version < "3.3"',
+                      'scandir; python_version < "3.5"'],
 )
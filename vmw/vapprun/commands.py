@@ -61,6 +61,5 @@ def _which(program):
 
 _setup_path()
 
-MKISOFS_CMD = _which("mkisofs")
 VMRUN_CMD = _which("vmrun")
 VDISKMANAGER_CMD = _which("vmware-vdiskmanager")
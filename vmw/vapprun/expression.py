@@ -0,0 +1,111 @@
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""expression handles the ${...} references in property values and appUrls
+
+A reference has one of these forms:
+
+  ${key}            The value of key
+  ${key|default}    The value of key, or default if it is empty or undefined
+  ${key:Network}    The IP pool setting key (e.g. ${gateway:Network})
+
+References can be mixed with text and with each other, for example
+http://${ip}:${port|8080}/. Strings are parsed once into a list of tokens.
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import re
+
+referenceExp = re.compile(r"\${([\w\.]+)(?::([\w\.]+))?(?:\|([^}]*))?}")
+
+# Compiled expressions, shared by all properties with the same value
+expressionCache = {}
+
+
+class Reference(object):
+
+    def __init__(self, text, key, network, default):
+        self.text = text
+        self.key = key
+        self.network = network
+        self.default = default
+
+
+class Expression(object):
+
+    def __init__(self, text):
+        self.text = text
+        self.tokens = []  # Strings and References
+        self.references = []
+        self.malformed = False
+
+        pos = 0
+        for m in referenceExp.finditer(text):
+            self.addText(text[pos:m.start()])
+            ref = Reference(m.group(0), m.group(1), m.group(2), m.group(3))
+            self.tokens.append(ref)
+            self.references.append(ref)
+            pos = m.end()
+        self.addText(text[pos:])
+
+    def addText(self, text):
+        if len(text) == 0:
+            return
+        if text.find("${") >= 0:
+            self.malformed = True
+        self.tokens.append(text)
+
+    def isValid(self):
+        """Returns True if this is a well formed property expression"""
+        return len(self.references) > 0 and not self.malformed
+
+    def singleReference(self):
+        """Returns the reference if the expression is nothing else"""
+        if len(self.tokens) == 1 and len(self.references) == 1:
+            return self.references[0]
+        return None
+
+    def expand(self, resolve, missing=None, blankIfEmpty=False):
+        """Substitutes the references.
+
+        resolve(ref) returns the value of a reference, or None if it is
+        undefined. An undefined reference without a default is replaced
+        by missing(ref), or left as is if missing is None. If blankIfEmpty
+        is set, a reference with an empty value blanks the whole result.
+        """
+        out = []
+        for token in self.tokens:
+            if not isinstance(token, Reference):
+                out.append(token)
+                continue
+
+            val = resolve(token)
+            if not val and token.default is not None:
+                val = token.default
+            elif val is None:
+                val = token.text if missing is None else missing(token)
+            elif len(val) == 0 and blankIfEmpty:
+                return ""
+            out.append(val)
+        return "".join(out)
+
+
+def CompileExpression(text):
+    expression = expressionCache.get(text)
+    if expression is None:
+        expression = Expression(text)
+        expressionCache[text] = expression
+    return expression
@@ -0,0 +1,148 @@
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""fsck finds the files in a workspace that are not used by it"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import marshal
+import os
+
+from .utils import AtomicWriteFile, OsMkdirs
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+def FileIdentity(path, st):
+    """Returns what identifies the file path with lstat result st"""
+    if st.st_ino == 0:
+        # No inode numbers (e.g. Python 2 on Windows)
+        return os.path.normcase(os.path.abspath(path))
+    return (st.st_dev, st.st_ino)
+
+
+class WorkspaceScanner(object):
+    """Lists the files and directories of a workspace that are not used.
+
+    Files are told apart by their device and inode, so a symbolic link
+    or another spelling of a path neither hides nor duplicates a file.
+    Directories used with all their content (like the directory of a
+    .vmx file) are not descended into.
+
+    With a manifest file, the content of every directory is saved with
+    its modification time, and later scans only list the directories
+    that changed since.
+    """
+
+    VERSION = 1
+
+    def __init__(self, dirname, manifestFile=None):
+        self.dir = dirname
+        self.used = set()  # Identities of used files and directories
+        self.usedTrees = set()  # Identities of directories used with content
+        self.manifestFile = manifestFile
+        self.manifest = {}  # Relative path -> (stamp, entries)
+        self.scanned = {}
+        if manifestFile is not None:
+            self.readManifest()
+
+    def readManifest(self):
+        try:
+            with open(self.manifestFile, "rb") as f:
+                (version, manifest) = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return
+        if version == self.VERSION:
+            self.manifest = manifest
+
+    def saveManifest(self):
+        data = marshal.dumps((self.VERSION, self.scanned))
+        OsMkdirs(os.path.dirname(self.manifestFile))
+        AtomicWriteFile(self.manifestFile, data, syncDir=False)
+
+    def identity(self, path):
+        try:
+            return FileIdentity(path, os.lstat(path))
+        except OSError:
+            return None
+
+    def addFile(self, path):
+        """Marks a file or directory as used"""
+        identity = self.identity(path)
+        if identity is not None:
+            self.used.add(identity)
+
+    def addTree(self, path):
+        """Marks a directory and everything in it as used"""
+        identity = self.identity(path)
+        if identity is not None:
+            self.usedTrees.add(identity)
+
+    def listDir(self, path, st):
+        """Returns the (name, isDir, inode) of the entries of path"""
+        rel = os.path.relpath(path, self.dir)
+        stamp = "%r:%d" % (st.st_mtime, st.st_ino)
+        cached = self.manifest.get(rel)
+        if cached is not None and cached[0] == stamp:
+            entries = cached[1]
+        else:
+            entries = []
+            for e in scandir(path):
+                try:
+                    entries.append((e.name, e.is_dir(follow_symlinks=False),
+                                    e.inode()))
+                except OSError:
+                    pass  # Removed while listing
+        self.scanned[rel] = (stamp, entries)
+        return entries
+
+    def scanDir(self, path, st, stray):
+        identity = FileIdentity(path, st)
+        if identity in self.usedTrees:
+            return
+
+        for name, isDir, inode in self.listDir(path, st):
+            child = os.path.join(path, name)
+            if isDir:
+                try:
+                    childSt = os.lstat(child)
+                except OSError:
+                    continue
+                self.scanDir(child, childSt, stray)
+            else:
+                if inode == 0:
+                    childId = os.path.normcase(os.path.abspath(child))
+                else:
+                    childId = (st.st_dev, inode)
+                if childId not in self.used:
+                    stray.append((child, False))
+
+        if identity not in self.used:
+            stray.append((path, True))
+
+    def scan(self):
+        """Returns the (path, isDir) of the files and directories not used.
+
+        The content of a directory comes before the directory itself.
+        """
+        stray = []
+        self.scanned = {}
+        self.scanDir(self.dir, os.lstat(self.dir), stray)
+        if self.manifestFile is not None:
+            self.saveManifest()
+        return stray
@@ -12,62 +12,321 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""ippool handles pool of IP addresses for vApp"""
+"""ippool handles pool of IP addresses for vApp
+
+A pool is specified as a comma separated list of ranges, each one of:
+
+  192.168.0.200#8             8 addresses starting at 192.168.0.200
+  192.168.0.200-192.168.0.207 The addresses from the first to the last
+  10.20.60.0/22               The host addresses of a network
+  192.168.0.5                 A single address
+
+The addresses are kept as integer ranges with one bit per address
+telling whether it is in use. Pools are limited to MAX_POOL_SIZE
+addresses (a /16 network).
+
+The addresses handed out are recorded in a lease file of the workspace.
+"""
 
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-import re
+import bisect
+import os
+import time
+
+import ipaddress
+from six import text_type
+
+from .utils import FileLock, NewXmlNode, ReadXmlDoc
+
+MAX_IP = 2 ** 32 - 1
+MAX_POOL_SIZE = 2 ** 16  # Addresses, a /16 network
+
+
+class IpRangeError(Exception):
+    """An IP pool specification that cannot be used"""
+    pass
 
 
 class IpPool(object):
 
-    def __init__(self, ipSet):
-        self.ipSet = ipSet
-        self.reserved = []
+    def __init__(self, ranges):
+        self.starts = []
+        self.ends = []
+        self.offsets = []  # Index of the first address of each range
+        size = 0
+        for start, end in ranges:
+            self.starts.append(start)
+            self.ends.append(end)
+            self.offsets.append(size)
+            size += end - start + 1
+        # One bit per address. The padding bits of the last byte are
+        # marked used, so they are never handed out.
+        self.size = size
+        self.used = bytearray((size + 7) // 8)
+        if size % 8 != 0:
+            self.used[-1] = 0xFF & ~((1 << (size % 8)) - 1)
+        self.freeCount = size
+        self.lowestFree = 0  # No address below it is free
+
+    def copy(self):
+        """Returns a pool of the same addresses, all of them free"""
+        return IpPool(zip(self.starts, self.ends))
+
+    def index(self, ip):
+        """Returns the index of ip in the pool, or None"""
+        try:
+            n = int(ipaddress.IPv4Address(text_type(ip)))
+        except ValueError:
+            return None
+        i = bisect.bisect_right(self.starts, n) - 1
+        if i < 0 or n > self.ends[i]:
+            return None
+        return self.offsets[i] + n - self.starts[i]
+
+    def address(self, index):
+        i = bisect.bisect_right(self.offsets, index) - 1
+        n = self.starts[i] + index - self.offsets[i]
+        return str(ipaddress.IPv4Address(n))
+
+    def isUsed(self, index):
+        return self.used[index >> 3] & (1 << (index & 7)) != 0
+
+    def setUsed(self, index, used):
+        if used:
+            self.used[index >> 3] |= 1 << (index & 7)
+        else:
+            self.used[index >> 3] &= ~(1 << (index & 7))
+
+    def find(self, used, index, stop):
+        """Returns the first index in [index, stop) that is used (or free)
+
+        -1 is returned if there is none. Bytes with all addresses in the
+        other state are skipped as a whole.
+        """
+        skip = 0 if used else 0xFF
+        while index < stop:
+            if index & 7 == 0 and self.used[index >> 3] == skip:
+                index += 8
+                continue
+            if self.isUsed(index) == used:
+                return index
+            index += 1
+        return -1
 
     def allocate(self):
-        if len(self.ipSet) == 0:
+        """Returns the lowest free address, or None if there is none"""
+        index = self.find(False, self.lowestFree, self.size)
+        if index < 0:
+            self.lowestFree = self.size
             return None
-        return self.ipSet.pop()
+        self.setUsed(index, True)
+        self.freeCount -= 1
+        self.lowestFree = index + 1
+        return self.address(index)
 
     def reserve(self, reserveSet):
-        self.reserved += reserveSet.union(self.ipSet)
-        self.ipSet = self.ipSet.difference(reserveSet)
+        """Marks the addresses in use. Addresses not in the pool are ignored"""
+        for ip in reserveSet:
+            index = self.index(ip)
+            if index is not None and not self.isUsed(index):
+                self.setUsed(index, True)
+                self.freeCount -= 1
 
     def unreserve(self, ip):
-        if ip in self.reserved:
-            self.ipSet.add(ip)
-            self.reserved.remove(ip)
+        index = self.index(ip)
+        if index is not None and self.isUsed(index):
+            self.setUsed(index, False)
+            self.freeCount += 1
+            self.lowestFree = min(self.lowestFree, index)
 
+    def iterFree(self):
+        """Yields the free addresses as IPv4Address in numeric order"""
+        for first, last in self.iterFreeRanges():
+            for n in range(int(first), int(last) + 1):
+                yield ipaddress.IPv4Address(n)
 
-def CreateIpPool(ipPoolSpec):
-    def nextIp(ipIn):
-        ipOut = list(ipIn)
-        ipOut[3] = ipOut[3] + 1
-        pos = 3
-        while pos >= 0 and ipOut[pos] > 255:
-            ipOut[pos] = 0
-            ipOut[pos - 1] = ip[pos - 1] + 1
-            pos = pos - 1
-        if ipOut[0] > 255:
-            return ipIn
-        return ipOut
-
-    if len(ipPoolSpec) == 0:
-        return IpPool(set())
-
-    patt = re.compile(
-        r"^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})#(\d{1,3})$")
-    m = patt.match(ipPoolSpec)
-    if m is None:
+    def iterFreeRanges(self):
+        """Yields the (first, last) IPv4Address of the free ranges"""
+        for start, end, offset in zip(self.starts, self.ends, self.offsets):
+            index = offset
+            last = offset + end - start
+            while index <= last:
+                index = self.find(False, index, last + 1)
+                if index < 0:
+                    break
+                stop = self.find(True, index, last + 1)
+                if stop < 0:
+                    stop = last + 1
+                yield (ipaddress.IPv4Address(start + index - offset),
+                       ipaddress.IPv4Address(start + stop - 1 - offset))
+                index = stop
+
+
+def ParseIpRange(spec):
+    """Returns the (first, last) integers of a range, or None"""
+    try:
+        if "#" in spec:
+            ip, count = spec.split("#", 1)
+            start = int(ipaddress.IPv4Address(ip.strip()))
+            count = int(count)
+            if count < 1 or start + count - 1 > MAX_IP:
+                return None
+            return (start, start + count - 1)
+
+        if "-" in spec:
+            first, last = spec.split("-", 1)
+            start = int(ipaddress.IPv4Address(first.strip()))
+            end = int(ipaddress.IPv4Address(last.strip()))
+            if end < start:
+                return None
+            return (start, end)
+
+        if "/" in spec:
+            network = ipaddress.IPv4Network(spec.strip(), strict=False)
+            start = int(network.network_address)
+            end = int(network.broadcast_address)
+            if network.prefixlen < 31:
+                # Leave out the network and broadcast addresses
+                start, end = start + 1, end - 1
+            return (start, end)
+
+        start = int(ipaddress.IPv4Address(spec.strip()))
+        return (start, start)
+    except ValueError:
         return None
 
-    ip = [int(m.group(i)) for i in range(1, 5)]
-    count = int(m.group(5))
-    ipSet = set()
-    for i in range(0, count):
-        ipSet.add(".".join([str(item) for item in ip]))
-        ip = nextIp(ip)
 
-    return IpPool(ipSet)
+def ParseIpPool(ipPoolSpec):
+    """Returns the merged (first, last) integer ranges of a pool
+
+    IpRangeError is raised for an invalid specification.
+    """
+    ranges = []
+    for spec in text_type(ipPoolSpec).split(","):
+        if len(spec.strip()) == 0:
+            continue
+        r = ParseIpRange(spec)
+        if r is None:
+            raise IpRangeError("Invalid IP range: " + spec.strip())
+        ranges.append(r)
+
+    # Merge overlapping and adjacent ranges
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def CreateIpPool(ipPoolSpec):
+    """Returns the IpPool of a specification
+
+    IpRangeError is raised if it is invalid or has more than
+    MAX_POOL_SIZE addresses.
+    """
+    ranges = ParseIpPool(ipPoolSpec)
+    size = sum([end - start + 1 for start, end in ranges])
+    if size > MAX_POOL_SIZE:
+        raise IpRangeError("IP range too large: %s (%d addresses, at most "
+                           "%d are supported)" %
+                           (ipPoolSpec, size, MAX_POOL_SIZE))
+    return IpPool(ranges)
+
+
+class IpLeaseDatabase(object):
+    """The IP addresses leased from a pool, kept in a file.
+
+    A lease records the entity and property key holding an address and
+    when it was handed out. Leases are changed in update(), which holds
+    a file lock while it reads and writes the file, so concurrent
+    vapprun runs never hand out the same address.
+    """
+
+    def __init__(self, fileName, lockName):
+        self.fileName = fileName
+        self.lockName = lockName
+        self.leases = {}  # (owner, key) -> (ip, time)
+        self.pool = None  # The range with the leased addresses reserved
+        self.changed = False
+
+    def exists(self):
+        return os.path.exists(self.fileName)
+
+    def read(self, ipRange):
+        """Reads the leases, without locking them"""
+        self.leases = {}
+        node = ReadXmlDoc(self.fileName)
+        if node is not None:
+            for n in node.list("lease"):
+                self.leases[(n.getAttr("entity"), n.getAttr("key"))] = \
+                    (n.getAttr("ip"), n.getAttrInt("time", 0))
+        self.pool = ipRange.copy()
+        self.pool.reserve([ip for ip, _ in self.leases.values()])
+        self.changed = False
+
+    def write(self):
+        node = NewXmlNode("leases")
+        for (owner, key), (ip, t) in sorted(self.leases.items()):
+            node.addChild(NewXmlNode("lease")
+                          .setAttr("entity", owner)
+                          .setAttr("key", key)
+                          .setAttr("ip", ip)
+                          .setAttr("time", t))
+        node.writeToFile(self.fileName)
+        self.changed = False
+
+    def update(self, ipRange, func):
+        """Applies func to the leases under the lease file lock"""
+        with FileLock(self.lockName):
+            self.read(ipRange)
+            result = func(self)
+            if self.changed or not self.exists():
+                self.write()
+        return result
+
+    def allocate(self, owner, key):
+        """Leases the lowest free address. Returns None if there is none"""
+        ip = self.pool.allocate()
+        if ip is not None:
+            self.leases[(owner, key)] = (ip, int(time.time()))
+            self.changed = True
+        return ip
+
+    def release(self, owner, key):
+        lease = self.leases.pop((owner, key), None)
+        if lease is not None:
+            if lease[0] not in [ip for ip, _ in self.leases.values()]:
+                self.pool.unreserve(lease[0])
+            self.changed = True
+
+    def releaseOwner(self, owner):
+        for o, key in list(self.leases):
+            if o == owner:
+                self.release(o, key)
+
+    def renameOwner(self, owner, newOwner):
+        for o, key in list(self.leases):
+            if o == owner:
+                self.leases[(newOwner, key)] = self.leases.pop((o, key))
+                self.changed = True
+
+    def replace(self, used):
+        """Sets the leases to used, a (owner, key) -> ip map.
+
+        Leases of the same address keep their time.
+        """
+        leases = {}
+        now = int(time.time())
+        for lease, ip in used.items():
+            old = self.leases.get(lease)
+            leases[lease] = old if old is not None and old[0] == ip \
+                else (ip, now)
+        if leases != self.leases:
+            self.leases = leases
+            self.changed = True
+        self.pool = self.pool.copy()
+        self.pool.reserve([ip for ip, _ in leases.values()])
@@ -15,92 +15,326 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
-import os
-import subprocess
-import sys
-import tempfile
+import re
+import struct
+import threading
+import time
 from string import Template
+from xml.sax.saxutils import escape
 
-from .commands import MKISOFS_CMD
-from .utils import OsTryRemove
 
+class OvfEnvRenderer(object):
+    """Renders OVF environment documents.
 
-class OvfEnv(object):
-
-    def __init__(self, identifier, env):
-        self._id = identifier
-        self._env = env
+    The documents of all VMs in a vApp carry the property sections of
+    every sibling. Each section is serialized once and reused until the
+    properties of its entity change, so a renderer should be shared by
+    all VMs started together.
+    """
 
-    def create_iso(self, fname):
-        imagedir = tempfile.mkdtemp()
-        path = os.path.join(imagedir, "ovf-env.xml")
-
-        with open(path, "w") as f:
-            f.write(self.create_doc())
-
-        OsTryRemove(fname)
-        cmd = [MKISOFS_CMD,
-               "-r",  # don't propagate owner/permissions
-               "-V", "OVF ENV",  # align label with what vsphere does
-               "-quiet",
-               "-rock",
-               "-joliet",
-               "-full-iso9660-filenames",
-               "-o", fname,
-               imagedir]
-        try:
-            subprocess.call(cmd)
-        except Exception:
-            print("Error: Failed to execute command '%s'" % (MKISOFS_CMD))
-            sys.exit(1)
-
-        os.remove(path)
-        os.rmdir(imagedir)
-
-    def create_doc(self):
-        header = Template('''<?xml version="1.0" encoding="UTF-8"?>
+    _header = Template('''<?xml version="1.0" encoding="UTF-8"?>
 <Environment xmlns="http://schemas.dmtf.org/ovf/environment/1"
              xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"
              xmlns:oe="http://schemas.dmtf.org/ovf/environment/1"
              oe:id="${id}">''')
-        platformSection = '''   <PlatformSection>
+    _platform_section = '''   <PlatformSection>
        <Kind>vapprun</Kind>
        <Version>1.0</Version>
        <Vendor>VMware, Inc.</Vendor>
        <Locale>en_US</Locale>
    </PlatformSection>'''
-        propertyHeader = '''
+    _property_header = '''
    <PropertySection>'''
-        propertyEntry = Template('''
+    _property_entry = Template('''
       <Property oe:key="${key}" oe:value="${value}"/>''')
-        propertyFooter = '''
+    _property_footer = '''
    </PropertySection>'''
-        entityHeader = Template('''
+    _entity_header = Template('''
     <Entity oe:id="${id}">''')
-        entityFooter = '''
+    _entity_footer = '''
     </Entity>'''
-        footer = '''
+    _footer = '''
 </Environment>
 '''
 
-        def createPropSection(props, out):
-            out.append(propertyHeader)
-            for key, value in props.items():
-                out.append(propertyEntry.substitute(key=key, value=value))
-            out.append(propertyFooter)
-
-        # propEnv = vappEnv[selfId]
-
-        # String join is a very efficient way of building strings in python
-        out = []
-        out.append(header.substitute(id=self._id))
-        out.append(platformSection)
-        createPropSection(self._env[self._id], out)
-        for _id in self._env:
-            if _id != self._id:
-                out.append(entityHeader.substitute(id=_id))
-                createPropSection(self._env[_id], out)
-                out.append(entityFooter)
-        out.append(footer)
-
-        return ''.join(out)
+    # Whitespace has to be escaped to survive attribute normalization
+    _attr_entities = {'"': "&quot;", "\n": "&#10;", "\r": "&#13;",
+                      "\t": "&#9;"}
+
+    def __init__(self):
+        self._sections = {}  # id -> (props, section, entity section)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _attr(cls, value):
+        return escape(value, cls._attr_entities)
+
+    def _render(self, identifier, props):
+        out = [self._property_header]
+        for key, value in props.items():
+            out.append(self._property_entry.substitute(
+                key=self._attr(key), value=self._attr(value)))
+        out.append(self._property_footer)
+        section = "".join(out)
+        entity = "".join([
+            self._entity_header.substitute(id=self._attr(identifier)),
+            section,
+            self._entity_footer])
+        return (dict(props), section, entity)
+
+    def _lookup(self, identifier, props):
+        with self._lock:
+            cached = self._sections.get(identifier)
+        if cached is None or cached[0] != props:
+            cached = self._render(identifier, props)
+            with self._lock:
+                self._sections[identifier] = cached
+        return cached
+
+    def create_doc(self, identifier, env):
+        """Returns the document for identifier.
+
+        env maps the id of the entity and of its siblings to their
+        properties.
+        """
+        out = [self._header.substitute(id=self._attr(identifier)),
+               self._platform_section,
+               self._lookup(identifier, env[identifier])[1]]
+        for _id in env:
+            if _id != identifier:
+                out.append(self._lookup(_id, env[_id])[2])
+        out.append(self._footer)
+
+        return "".join(out)
+
+
+class OvfEnv(object):
+
+    def __init__(self, identifier, env, renderer=None):
+        self._id = identifier
+        self._env = env
+        if renderer is None:
+            renderer = OvfEnvRenderer()
+        self._renderer = renderer
+
+    def create_doc(self):
+        return self._renderer.create_doc(self._id, self._env)
+
+
+class IsoImage(object):
+    """In-memory ISO9660 image with Joliet and Rock Ridge extensions.
+
+    This covers what the OVF environment needs: a handful of small files
+    in the root directory. The result matches what 'mkisofs -r -joliet'
+    produces closely enough for guests to mount it either way.
+    """
+
+    SECTOR = 2048
+
+    # Fixed layout, file data starts at FIRST_FILE_SECTOR
+    PVD_SECTOR = 16
+    SVD_SECTOR = 17
+    TERMINATOR_SECTOR = 18
+    PATH_TABLE_SECTORS = (19, 20, 21, 22)  # L/M primary, L/M Joliet
+    ROOT_SECTOR = 23
+    JOLIET_ROOT_SECTOR = 24
+    CONTINUATION_SECTOR = 25
+    FIRST_FILE_SECTOR = 26
+
+    RRIP_ID = b"RRIP_1991A"
+    RRIP_DESCRIPTOR = (b"THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES "
+                       b"SUPPORT FOR POSIX FILE SYSTEM SEMANTICS")
+    RRIP_SOURCE = (b"PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE."
+                   b"  SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR"
+                   b" FOR CONTACT INFORMATION.")
+
+    def __init__(self, label, files, timestamp=None):
+        self._label = label
+        self._files = sorted(files.items())
+        self._time = time.gmtime(timestamp)
+
+    @classmethod
+    def _both16(cls, n):
+        return struct.pack(str("<H"), n) + struct.pack(str(">H"), n)
+
+    @classmethod
+    def _both32(cls, n):
+        return struct.pack(str("<I"), n) + struct.pack(str(">I"), n)
+
+    @classmethod
+    def _sectors(cls, size):
+        return (size + cls.SECTOR - 1) // cls.SECTOR
+
+    @classmethod
+    def _iso_name(cls, name):
+        base, _, ext = name.upper().rpartition(".")
+        if len(base) == 0:
+            base, ext = ext, ""
+        base = re.sub(r"[^A-Z0-9_]", "_", base)[:30 - len(ext)]
+        ext = re.sub(r"[^A-Z0-9_]", "_", ext)
+        return (base + "." + ext + ";1").encode("ascii")
+
+    @classmethod
+    def _joliet_name(cls, name):
+        return name[:64].encode("utf-16-be")
+
+    @classmethod
+    def _text(cls, s, size, joliet=False):
+        """Space padded identifier of size bytes"""
+        if joliet:
+            data = s.encode("utf-16-be")
+            pad = " " * (size // 2)
+            return (data + pad.encode("utf-16-be"))[:size].ljust(size, b"\0")
+        return s.upper().encode("ascii")[:size].ljust(size, b" ")
+
+    def _dir_date(self):
+        t = self._time
+        return struct.pack(str("7B"), t.tm_year - 1900, t.tm_mon, t.tm_mday,
+                           t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+    def _volume_date(self):
+        t = self._time
+        digits = "%04d%02d%02d%02d%02d%02d00" % (t.tm_year, t.tm_mon,
+                                                 t.tm_mday, t.tm_hour,
+                                                 t.tm_min, t.tm_sec)
+        return digits.encode("ascii") + b"\0"
+
+    def _dir_record(self, ident, extent, size, is_dir, system_use=b""):
+        # The identifier is padded to an even length, as is the record
+        pad = b"\0" if len(ident) % 2 == 0 else b""
+        if (33 + len(ident) + len(pad) + len(system_use)) % 2 != 0:
+            system_use += b"\0"
+        length = 33 + len(ident) + len(pad) + len(system_use)
+        return (struct.pack(str("BB"), length, 0) +
+                self._both32(extent) +
+                self._both32(size) +
+                self._dir_date() +
+                struct.pack(str("BBB"), 2 if is_dir else 0, 0, 0) +
+                self._both16(1) +
+                struct.pack(str("B"), len(ident)) +
+                ident + pad + system_use)
+
+    @classmethod
+    def _susp(cls, tag, data):
+        return tag + struct.pack(str("BB"), 4 + len(data), 1) + data
+
+    @classmethod
+    def _rr_px(cls, is_dir):
+        mode = 0o40555 if is_dir else 0o100444
+        return cls._susp(b"PX", cls._both32(mode) +
+                         cls._both32(2 if is_dir else 1) +
+                         cls._both32(0) + cls._both32(0))
+
+    def _rr_er(self):
+        return self._susp(b"ER", struct.pack(str("4B"),
+                                             len(self.RRIP_ID),
+                                             len(self.RRIP_DESCRIPTOR),
+                                             len(self.RRIP_SOURCE), 1) +
+                          self.RRIP_ID + self.RRIP_DESCRIPTOR +
+                          self.RRIP_SOURCE)
+
+    def _root_dir(self, extents, joliet):
+        own = self.JOLIET_ROOT_SECTOR if joliet else self.ROOT_SECTOR
+        dot_use = dotdot_use = b""
+        if not joliet:
+            # SP and the continuation holding ER announce Rock Ridge
+            er = self._rr_er()
+            dot_use = (self._susp(b"SP", b"\xbe\xef\0") +
+                       self._susp(b"RR", b"\x01") +
+                       self._rr_px(True) +
+                       self._susp(b"CE",
+                                  self._both32(self.CONTINUATION_SECTOR) +
+                                  self._both32(0) +
+                                  self._both32(len(er))))
+            dotdot_use = self._susp(b"RR", b"\x01") + self._rr_px(True)
+
+        files = []
+        for (name, data), extent in zip(self._files, extents):
+            if joliet:
+                files.append((self._joliet_name(name), extent, len(data),
+                              b""))
+            else:
+                use = (self._susp(b"RR", b"\x09") +
+                       self._rr_px(False) +
+                       self._susp(b"NM", b"\0" + name.encode("utf-8")))
+                files.append((self._iso_name(name), extent, len(data), use))
+
+        # Directory records must be sorted by identifier
+        records = [self._dir_record(b"\0", own, self.SECTOR, True, dot_use),
+                   self._dir_record(b"\1", own, self.SECTOR, True,
+                                    dotdot_use)]
+        for ident, extent, size, use in sorted(files):
+            records.append(self._dir_record(ident, extent, size, False, use))
+
+        data = b"".join(records)
+        if len(data) > self.SECTOR:
+            raise ValueError("Too many files for an ISO root directory")
+        return data
+
+    def _path_table(self, extent, big_endian):
+        fmt = str(">IH") if big_endian else str("<IH")
+        return struct.pack(str("BB"), 1, 0) + struct.pack(fmt, extent, 1) + \
+            b"\0\0"
+
+    def _volume_descriptor(self, total, joliet):
+        vd = bytearray(self.SECTOR)
+        vd[0:7] = struct.pack(str("B"), 2 if joliet else 1) + b"CD001\1"
+        vd[8:40] = self._text("", 32, joliet)
+        vd[40:72] = self._text(self._label, 32, joliet)
+        vd[80:88] = self._both32(total)
+        if joliet:
+            vd[88:91] = b"%/E"  # UCS-2 level 3
+        vd[120:124] = self._both16(1)
+        vd[124:128] = self._both16(1)
+        vd[128:132] = self._both16(self.SECTOR)
+        vd[132:140] = self._both32(10)
+        (l_table, m_table) = self.PATH_TABLE_SECTORS[2:] if joliet \
+            else self.PATH_TABLE_SECTORS[:2]
+        vd[140:144] = struct.pack(str("<I"), l_table)
+        vd[148:152] = struct.pack(str(">I"), m_table)
+        root = self.JOLIET_ROOT_SECTOR if joliet else self.ROOT_SECTOR
+        vd[156:190] = self._dir_record(b"\0", root, self.SECTOR, True)
+        vd[190:574] = self._text("", 384, joliet)
+        vd[574:702] = self._text("vapprun", 128, joliet)
+        vd[702:813] = self._text("", 111, joliet)
+        vd[813:830] = self._volume_date()
+        vd[830:847] = self._volume_date()
+        vd[847:864] = b"0" * 16 + b"\0"
+        vd[864:881] = b"0" * 16 + b"\0"
+        vd[881] = 1
+        return vd
+
+    def create(self):
+        """Returns the image as bytes"""
+        self._files = [(name, data.encode("utf-8")
+                        if not isinstance(data, bytes) else data)
+                       for name, data in self._files]
+        extents = []
+        sector = self.FIRST_FILE_SECTOR
+        for _, data in self._files:
+            extents.append(sector)
+            sector += self._sectors(len(data))
+        total = sector
+
+        image = bytearray(total * self.SECTOR)
+
+        def put(sector, data):
+            offset = sector * self.SECTOR
+            image[offset:offset + len(data)] = data
+
+        terminator = struct.pack(str("B"), 255) + b"CD001\1"
+        put(self.PVD_SECTOR, self._volume_descriptor(total, False))
+        put(self.SVD_SECTOR, self._volume_descriptor(total, True))
+        put(self.TERMINATOR_SECTOR, terminator)
+        for i, (root, big_endian) in enumerate(
+                [(self.ROOT_SECTOR, False), (self.ROOT_SECTOR, True),
+                 (self.JOLIET_ROOT_SECTOR, False),
+                 (self.JOLIET_ROOT_SECTOR, True)]):
+            put(self.PATH_TABLE_SECTORS[i], self._path_table(root, big_endian))
+        put(self.ROOT_SECTOR, self._root_dir(extents, False))
+        put(self.JOLIET_ROOT_SECTOR, self._root_dir(extents, True))
+        put(self.CONTINUATION_SECTOR, self._rr_er())
+        for (_, data), extent in zip(self._files, extents):
+            put(extent, data)
+
+        return bytes(image)
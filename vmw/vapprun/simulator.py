@@ -0,0 +1,168 @@
+# Copyright 2009-2015 VMware, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""simulator is a hypervisor backend that does not need VMware installed.
+
+VMs only exist as entries in a JSON state file, so the start/stop
+orchestration of vapprun can be exercised on any machine. It is selected
+with VAPPRUN_BACKEND=simulator and configured through these environment
+variables:
+
+  VAPPRUN_SIM_STATE         State file (default: ~/.vapprun-simulator.json)
+  VAPPRUN_SIM_BOOT_TIME     Seconds until a guest reports its IP (default: 2)
+  VAPPRUN_SIM_STOP_TIME     Seconds a soft power-off takes (default: 0)
+  VAPPRUN_SIM_IP_BASE       First IP address handed out (default: 172.16.0.1)
+  VAPPRUN_SIM_FAILURE_RATE  Probability that a power operation fails
+                            (default: 0)
+"""
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import os
+import random
+import socket
+import struct
+import time
+
+from .utils import FileLock, GetEnvOption
+from .vmrun import HypervisorBackend
+
+
+class SimulatorBackend(HypervisorBackend):
+
+    def __init__(self):
+        defaultState = os.path.join(os.path.expanduser("~"),
+                                    ".vapprun-simulator.json")
+        self.stateFile = GetEnvOption("SIM_STATE", defaultState)
+        self.bootTime = float(GetEnvOption("SIM_BOOT_TIME", 2))
+        self.stopTime = float(GetEnvOption("SIM_STOP_TIME", 0))
+        self.ipBase = GetEnvOption("SIM_IP_BASE", "172.16.0.1")
+        self.failureRate = float(GetEnvOption("SIM_FAILURE_RATE", 0))
+
+    def loadState(self):
+        try:
+            with open(self.stateFile, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"vms": {}, "nextIp": 0}
+
+    def saveState(self, state):
+        with open(self.stateFile, "w") as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+
+    def readState(self):
+        with FileLock(self.stateFile + ".lock"):
+            return self.loadState()
+
+    def updateState(self, func):
+        """Applies func to the state under the state file lock"""
+        with FileLock(self.stateFile + ".lock"):
+            state = self.loadState()
+            result = func(state)
+            self.saveState(state)
+        return result
+
+    def simulateFailure(self, action, vmxPath):
+        if random.random() < self.failureRate:
+            print("Error: Simulated failure to", action, vmxPath)
+            return True
+        return False
+
+    def allocateIp(self, state):
+        base = struct.unpack(str("!I"), socket.inet_aton(self.ipBase))[0]
+        ip = socket.inet_ntoa(struct.pack(str("!I"), base + state["nextIp"]))
+        state["nextIp"] += 1
+        return ip
+
+    def powerOn(self, vmxPath):
+        if self.simulateFailure("power on", vmxPath):
+            return False
+
+        key = self.normalizeVmxPath(vmxPath)
+
+        def start(state):
+            if key in state["vms"]:
+                print("Error: The virtual machine is already running")
+                return False
+            state["vms"][key] = {"bootedAt": time.time() + self.bootTime,
+                                 "ip": self.allocateIp(state),
+                                 "variables": {}}
+            return True
+
+        return self.updateState(start)
+
+    def powerOff(self, vmxPath, hard=False, timeout=None):
+        if not hard:
+            if timeout is not None and self.stopTime > timeout:
+                time.sleep(timeout)
+                return False
+            time.sleep(self.stopTime)
+        if self.simulateFailure("power off", vmxPath):
+            return False
+
+        key = self.normalizeVmxPath(vmxPath)
+
+        def stop(state):
+            if key not in state["vms"]:
+                print("Error: The virtual machine is not powered on")
+                return False
+            del state["vms"][key]
+            return True
+
+        return self.updateState(stop)
+
+    def readRuntimeVariable(self, vmxPath, name):
+        vm = self.readState()["vms"].get(self.normalizeVmxPath(vmxPath))
+        if vm is None:
+            return "error: the virtual machine is not powered on"
+        if name == "guestinfo.ip":
+            if time.time() < vm["bootedAt"]:
+                return ""
+            return vm["ip"]
+        return vm["variables"].get(name, "").lower()
+
+    def waitForGuestIp(self, vmxPath, timeout):
+        # Blocks like 'vmrun getGuestIPAddress -wait' would
+        vm = self.readState()["vms"].get(self.normalizeVmxPath(vmxPath))
+        if vm is None:
+            return HypervisorBackend.waitForGuestIp(self, vmxPath, timeout)
+
+        delay = vm["bootedAt"] - time.time()
+        if delay > timeout:
+            time.sleep(timeout)
+            return ""
+        time.sleep(max(delay, 0))
+        return self.getIP(vmxPath)
+
+    def writeRuntimeVariable(self, vmxPath, name, value):
+        key = self.normalizeVmxPath(vmxPath)
+
+        def write(state):
+            if key not in state["vms"]:
+                print("Error: The virtual machine is not powered on")
+                return False
+            state["vms"][key]["variables"][name] = value
+            return True
+
+        return self.updateState(write)
+
+    def listRunningVms(self):
+        return set(self.readState()["vms"].keys())
+
+    def createSparseVmdk(self, filename, diskSize):
+        with open(filename, "w") as f:
+            f.write("# Simulated disk of %sGB\n" % diskSize)
+        return True
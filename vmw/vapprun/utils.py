@@ -16,12 +16,32 @@ from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
 import os
-import xml.dom.minidom
+import subprocess
+import sys
+import threading
 
+from six import StringIO, reraise
+from six.moves import queue
 from six.moves.configparser import ConfigParser, NoOptionError, NoSectionError
 
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
 options = {}
 
+XML_DECLARATION = '<?xml version="1.0" ?>\n'
+
+# Default number of worker threads used for concurrent vmrun calls
+DEFAULT_WORKERS = 8
+
 
 def GetCmdOption(name, default):
     if name not in options:
@@ -33,6 +53,61 @@ def SetCmdOption(name, value):
     options[name] = value
 
 
+def GetEnvOption(name, default):
+    """Returns the value of the VAPPRUN_<name> environment variable"""
+    return os.environ.get("VAPPRUN_" + name, default)
+
+
+def GetWorkerCount():
+    try:
+        return max(1, int(GetEnvOption("WORKERS", DEFAULT_WORKERS)))
+    except ValueError:
+        return DEFAULT_WORKERS
+
+
+def ParallelMap(func, items, workers=None):
+    """Applies func to all items using a bounded pool of threads.
+
+    Results are returned in the order of items. If func raises (this
+    includes sys.exit), the remaining items are skipped and the first
+    exception is re-raised in the calling thread.
+    """
+    items = list(items)
+    if workers is None:
+        workers = GetWorkerCount()
+    workers = min(workers, len(items))
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    work = queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while not errors:
+            try:
+                (i, item) = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except BaseException:
+                errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+
+    if len(errors) > 0:
+        reraise(*errors[0])
+    return results
+
+
 def StrToBool(s, defaultValue=False):
     s = str(s)
     if len(s) == 0:
@@ -96,6 +171,81 @@ def OsFileListRemove(l):
             OsTryRemove(name)
 
 
+def OsSpawnDetached(args, cwd=None):
+    """Starts a process that keeps running after vapprun exits"""
+    kwargs = {}
+    if os.name == "nt":
+        # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        kwargs["creationflags"] = 0x00000008 | 0x00000200
+    else:
+        kwargs["preexec_fn"] = os.setsid
+        kwargs["close_fds"] = True
+    with open(os.devnull, "r+b") as devnull:
+        subprocess.Popen(args, cwd=cwd, stdin=devnull, stdout=devnull,
+                         stderr=devnull, **kwargs)
+
+
+def OsReplace(src, dst):
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        # Python 2 cannot replace an existing file on Windows
+        if sys.platform.startswith('win'):
+            OsTryRemove(dst)
+        os.rename(src, dst)
+
+
+def OsFsyncDir(dirname):
+    """Makes renames in dirname durable (a no-op where unsupported)"""
+    if sys.platform.startswith('win'):
+        return
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def AtomicWriteFile(fname, content, syncDir=True):
+    """Replaces fname with content.
+
+    The content is written to a temporary file in the same directory,
+    fsync'ed and renamed over fname, so readers either see the old or
+    the new file and a crash never leaves a torn one behind.
+    """
+    tmpName = "%s.%d.%d.tmp" % (fname, os.getpid(),
+                                threading.current_thread().ident)
+    fd = os.open(tmpName, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    mode = "wb" if isinstance(content, bytes) else "w"
+    try:
+        with os.fdopen(fd, mode) as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(fname):
+            os.chmod(tmpName, os.stat(fname).st_mode & 0o7777)
+        OsReplace(tmpName, fname)
+    except BaseException:
+        OsTryRemove(tmpName)
+        raise
+
+    if syncDir:
+        OsFsyncDir(os.path.dirname(os.path.abspath(fname)))
+
+
+def FileStamp(fileName):
+    """Returns a string that changes whenever the file is modified.
+
+    The inode number is included, so a file replaced by an editor is
+    noticed even when the modification time has a coarse resolution.
+    """
+    try:
+        st = os.stat(fileName)
+    except OSError:
+        return ""
+    return "%r:%d:%d" % (st.st_mtime, st.st_size, st.st_ino)
+
+
 def CreateRelPath(baseDir, dirname):
     d1 = os.path.realpath(baseDir)
     d2 = os.path.realpath(dirname)
@@ -113,6 +263,78 @@ def WriteTxtFile(fname, content):
         print(content, file=f)
 
 
+class FileLock(object):
+    """Exclusive lock on a file, shared between processes and threads"""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.f = None
+
+    def __enter__(self):
+        self.f = open(self.fileName, "a")
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+        else:
+            self.f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except IOError:
+                    pass  # LK_LOCK gives up after 10 seconds
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+        self.f = None
+
+
+class WorkspaceSession(object):
+    """Collects the configuration files changed by a command.
+
+    A file marked dirty is written once, when the session is committed,
+    no matter how often it changed. Files are replaced atomically and
+    every directory is synced once per commit.
+    """
+
+    def __init__(self):
+        self.pending = {}  # File name -> function returning an XmlNode
+        self.lock = threading.Lock()
+
+    def markDirty(self, fileName, getNode):
+        with self.lock:
+            self.pending[os.path.abspath(fileName)] = getNode
+
+    def discard(self, fileName):
+        with self.lock:
+            self.pending.pop(os.path.abspath(fileName), None)
+
+    def read(self, fileName):
+        """Returns the content of fileName, including uncommitted changes"""
+        with self.lock:
+            getNode = self.pending.get(os.path.abspath(fileName))
+        if getNode is not None:
+            return getNode()
+        return ReadXmlDoc(fileName)
+
+    def commit(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+
+        dirs = set()
+        for fileName in sorted(pending):
+            pending[fileName]().writeToFile(fileName, syncDir=False)
+            dirs.add(os.path.dirname(fileName))
+        for dirname in sorted(dirs):
+            OsFsyncDir(dirname)
+
+
 class MyConfigParser(ConfigParser):
 
     def get(self, section, key, default=""):
@@ -131,60 +353,92 @@ class MyConfigParser(ConfigParser):
 
 
 class XmlNode(object):
+    """An XML element.
+
+    Children must be added with addChild (or addXmlNode/addXmlTextNode),
+    which keeps the index used by the lookups up to date.
+    """
+
+    __slots__ = ("tag", "attrs", "value", "children", "tagIndex")
 
     def __init__(self, tag, attrs=None, value=None, children=None):
         self.tag = tag
         self.attrs = attrs or {}
         self.value = value
         self.children = children or []
+        self.tagIndex = None  # Tag -> children, built on the first lookup
+
+    def getTagIndex(self):
+        if self.tagIndex is None:
+            index = {}
+            for c in self.children:
+                index.setdefault(c.tag, []).append(c)
+            self.tagIndex = index
+        return self.tagIndex
 
     def list(self, tag):
-        return [c for c in self.children if c.tag == tag]
+        return list(self.getTagIndex().get(tag, []))
 
     def lookup(self, tag):
-        for c in self.children:
-            if c.tag == tag:
-                return c
+        l = self.getTagIndex().get(tag)
+        if l:
+            return l[0]
         return None
 
     def lookupChildTextNode(self, tag):
-        for c in self.children:
-            if c.tag == tag and c.value is not None:
+        for c in self.getTagIndex().get(tag, []):
+            if c.value is not None:
                 return (c.value.strip(), True)
         return ("", False)
 
     def updateChildTextNode(self, tag, val):
-        for c in self.children:
-            if c.tag == tag:
-                c.value = str(val).strip()
-                return
+        c = self.lookup(tag)
+        if c is not None:
+            c.value = str(val).strip()
 
-    def toXmlDom(self):
-        impl = xml.dom.minidom.getDOMImplementation()
-        doc = impl.createDocument(None, self.tag, None)
-        root = doc.documentElement
-        self.toXmlDomHelper(doc, root)
-        return doc
-
-    def toXmlDomHelper(self, doc, elem):
+    def writeXml(self, writer, indent=""):
+        """Writes the element the way minidom's writexml indents it"""
+        writer.write(indent + "<" + self.tag)
         for key, value in self.attrs.items():
-            elem.setAttribute(key, str(value))
+            writer.write(" %s=\"%s\"" % (key, XmlEscape(str(value))))
 
         if self.value is not None:
-            tn = doc.createTextNode(str(self.value).strip())
-            elem.appendChild(tn)
-
-        for cn in self.children:
-            en = doc.createElement(cn.tag)
-            cn.toXmlDomHelper(doc, en)
-            elem.appendChild(en)
+            text = XmlEscape(str(self.value).strip())
+            if len(self.children) == 0:
+                writer.write(">%s</%s>\n" % (text, self.tag))
+                return
+            writer.write(">\n%s  %s\n" % (indent, text))
+        elif len(self.children) == 0:
+            writer.write("/>\n")
+            return
+        else:
+            writer.write(">\n")
 
-    def writeToFile(self, name):
-        doc = self.toXmlDom()
-        f = open(name, "w")
-        doc.writexml(writer=f, addindent="  ", newl="\n")
-        doc.unlink()
-        f.close()
+        for c in self.children:
+            c.writeXml(writer, indent + "  ")
+        writer.write("%s</%s>\n" % (indent, self.tag))
+
+    def toXmlString(self):
+        f = StringIO()
+        f.write(XML_DECLARATION)
+        self.writeXml(f)
+        return f.getvalue()
+
+    def writeToFile(self, name, syncDir=True):
+        AtomicWriteFile(name, self.toXmlString(), syncDir)
+
+    def snapshot(self):
+        """Returns the content as written by writeToFile, for comparisons"""
+        value = "" if self.value is None else str(self.value).strip()
+        return (self.tag,
+                frozenset([(k, str(v)) for k, v in self.attrs.items()]),
+                value,
+                tuple([c.snapshot() for c in self.children]))
+
+    def asTuple(self):
+        """Returns the node as nested tuples (e.g. to marshal it)"""
+        return (self.tag, tuple(self.attrs.items()), self.value,
+                tuple([c.asTuple() for c in self.children]))
 
     def setAttr(self, key, value):
         self.attrs[key] = value
@@ -210,15 +464,14 @@ class XmlNode(object):
 
     def addChild(self, n):
         self.children.append(n)
+        self.tagIndex = None
         return self
 
     def addXmlNode(self, tag):
-        self.children.append(NewXmlNode(tag))
-        return self
+        return self.addChild(NewXmlNode(tag))
 
     def addXmlTextNode(self, tag, text):
-        self.children.append(NewXmlTextNode(tag, text))
-        return self
+        return self.addChild(NewXmlTextNode(tag, text))
 
     def dump(self, indent=""):
         print(indent, self.tag, self.attrs, self.value)
@@ -234,29 +487,69 @@ def NewXmlTextNode(tag, value):
     return XmlNode(tag, attrs=dict(), children=[], value=value)
 
 
+def XmlNodeFromTuple(t):
+    (tag, attrs, value, children) = t
+    return XmlNode(tag, dict(attrs), value,
+                   [XmlNodeFromTuple(c) for c in children])
+
+
+def XmlEscape(data):
+    return data.replace("&", "&amp;").replace("<", "&lt;"). \
+        replace("\"", "&quot;").replace(">", "&gt;")
+
+
 def ReadXmlDoc(filename):
     try:
-        doc = xml.dom.minidom.parse(filename)
-        node = ReadXmlElement(doc.documentElement)
-        doc.unlink()
+        return ParseXml(filename)
     except IOError:
         return None
-    return node
-
 
-def ReadXmlElement(elem):
-    attrs = {}
-    children = []
-    value = None
 
-    for i in range(0, elem.attributes.length):
-        a = elem.attributes.item(i)
-        attrs[a.name] = a.value
-
-    for c in elem.childNodes:
-        if c.nodeType == elem.ELEMENT_NODE:
-            children.append(ReadXmlElement(c))
-        elif c.nodeType == elem.TEXT_NODE:
-            value = c.data
-
-    return XmlNode(elem.tagName, attrs, value, children)
+def ParseXml(source):
+    """Parses an XML file name or file object into XmlNodes.
+
+    The elements are converted while they are parsed. The value of an
+    element is its last text segment, and namespace prefixes and
+    declarations are kept as written.
+    """
+    namespaces = []  # (prefix, uri) in scope
+    declared = []  # Namespaces declared by the next element
+    stack = []
+    root = None
+
+    def qualifiedName(name):
+        if name[0] != "{":
+            return name
+        uri, local = name[1:].split("}", 1)
+        for prefix, u in reversed(namespaces):
+            if u == uri:
+                return prefix + ":" + local if prefix else local
+        return local
+
+    events = ("start", "end", "start-ns", "end-ns")
+    for event, item in ElementTree.iterparse(source, events):
+        if event == "start":
+            attrs = dict([(qualifiedName(k), v)
+                          for k, v in item.attrib.items()])
+            for prefix, uri in declared:
+                attrs["xmlns:" + prefix if prefix else "xmlns"] = uri
+            declared = []
+            node = XmlNode(qualifiedName(item.tag), attrs, None, [])
+            if stack:
+                stack[-1].addChild(node)
+            else:
+                root = node
+            stack.append(node)
+        elif event == "end":
+            node = stack.pop()
+            node.value = item.text
+            for c in item:
+                if c.tail is not None:
+                    node.value = c.tail
+            del item[:]  # Converted already
+        elif event == "start-ns":
+            namespaces.append(item)
+            declared.append(item)
+        else:
+            namespaces.pop()
+    return root
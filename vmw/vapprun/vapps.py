@@ -15,24 +15,34 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import marshal
 import os
-import re
 import sys
+import threading
 import time
+from itertools import groupby
 from abc import ABCMeta, abstractmethod
 
 from six import add_metaclass
 
-from .ippool import CreateIpPool
-from .ovfenv import OvfEnv
-from .utils import (BoolToStr, CreateRelPath, GetCmdOption, NewXmlNode,
-                    NewXmlTextNode, OsFileList, OsFileListRemove, OsTryRemove,
-                    ReadXmlDoc, StrToBool)
-from .vmrun import getVmrunInstance
+from .ippool import CreateIpPool, IpLeaseDatabase, IpPool, IpRangeError
+from .expression import CompileExpression
+from .ovfenv import OvfEnv, OvfEnvRenderer
+from .utils import (AtomicWriteFile, BoolToStr, CreateRelPath, FileLock,
+                    FileStamp, GetCmdOption, GetEnvOption, NewXmlNode,
+                    NewXmlTextNode, OsFileList, OsFileListRemove, OsMkdirs,
+                    OsTryRemove, OsTryRmdir, ParallelMap, ReadXmlDoc,
+                    StrToBool, WorkspaceSession, XmlNodeFromTuple)
+from .vmrun import OvfEnvIsoCache, getVmrunInstance
 
 WORKSPACE_CFG_NAME = "vapprun.cfg"
 VM_CFG_NAME = "vm.cfg"
 VAPP_CFG_NAME = "vapp.cfg"
+CACHE_DIR_NAME = ".cache"
+LEASES_CFG_NAME = "leases.cfg"
+LEASES_LOCK_NAME = "leases.lock"
+TRASH_DIR_NAME = ".trash"
+TRASH_LOCK_NAME = ".lock"
 
 # Bumped if the XML format is changed in an incompatible way
 # (this is checked by ovftool)
@@ -41,6 +51,12 @@ VAPPRUN_CONFIG_VERSION = "1"
 # Global reference to vApp Inventory
 vappsInstance = None
 
+# Serializes updates of deployment parameters by concurrently started VMs
+deployParamsLock = threading.RLock()
+
+# Configuration files changed by the current command
+sessionInstance = WorkspaceSession()
+
 
 class abstractclassmethod(classmethod):
 
@@ -53,6 +69,8 @@ class abstractclassmethod(classmethod):
 
 class Property(object):
 
+    __slots__ = ("key", "type", "userConfig", "expression")
+
     def __init__(self, key="", typ="", value="", userConfig=True):
         self.key = key
         self.type = typ
@@ -70,50 +88,53 @@ class Property(object):
             .setAttr("value", self.value) \
             .setAttr("userConfigurable", BoolToStr(self.userConfig))
 
-    def parseMacro(self):
-        exp = re.compile(r"^\${([\w\.]+)(:([\w\.]+))?}$")
-        macro = exp.match(self.value)
-        if macro is None:
-            return (None, None)
-        (cmd, dummy, arg) = macro.groups()
-        return (cmd, arg)
+    @property
+    def value(self):
+        return self.expression.text
+
+    @value.setter
+    def value(self, value):
+        self.expression = CompileExpression(value)
+
+    def effectiveValue(self, deployParams, lookup=None):
+        """Returns the value of the property.
 
-    def effectiveValue(self, deployParams, parentEnv=None):
-        parentEnv = set() if parentEnv is None else parentEnv
+        lookup(key) returns the value of a property of the parent entity,
+        or None if the parent does not define it.
+        """
         if not self.isMacro():
-            val = deployParams[self.key].strip()
+            val = deployParams.getParam(self.key).strip()
             if not self.userConfig or len(val) == 0:
                 return self.value
             return val
 
-        (cmd, arg) = self.parseMacro()
-        if cmd is None:
-            print("Error: Invalid expression '%s' for property '%s'"
-                  % (self.value, self.key))
-            sys.exit(1)
-
-        if arg is None:
-            # Assignment
-            if cmd not in parentEnv:
-                print("Error: Undefined reference '%s' for property '%s'"
-                      % (cmd, self.key))
-                sys.exit(1)
-            return parentEnv[cmd]
-        else:
-            if arg != "Network":
-                print(("Error: Invalid network name '%s' for property '%s' " +
-                       "(it must be 'Network')")
-                      % (arg, self.key))
-                sys.exit(1)
-            (val, found) = getVAppsInstance().ipPool.lookupChildTextNode(cmd)
+        if not self.expression.isValid():
+            raise PropertyError("Invalid expression '%s' for property '%s'"
+                                % (self.value, self.key))
+
+        def resolve(ref):
+            if ref.network is None:
+                # Assignment
+                if lookup is None:
+                    return None
+                return lookup(ref.key)
+
+            if ref.network != "Network":
+                raise PropertyError(("Invalid network name '%s' for "
+                                     "property '%s' (it must be 'Network')")
+                                    % (ref.network, self.key))
+            pool = getVAppsInstance().ipPool
+            (val, found) = pool.lookupChildTextNode(ref.key)
             if not found:
-                print("Error: Invalid expression  '%s' for property '%s'"
-                      % (self.value, self.key))
-                sys.exit(1)
-
+                raise PropertyError("Invalid expression  '%s' for property "
+                                    "'%s'" % (self.value, self.key))
             return val
 
-        sys.exit(1)
+        def missing(ref):
+            raise PropertyError("Undefined reference '%s' for property '%s'"
+                                % (ref.key, self.key))
+
+        return self.expression.expand(resolve, missing)
 
     def isIp(self):
         return self.type.startswith("ip:")
@@ -125,10 +146,193 @@ class Property(object):
         return self.userConfig and not self.isMacro()
 
     def getAssignee(self):
-        (cmd, arg) = self.parseMacro()
-        if cmd is None or arg is not None:
+        ref = self.expression.singleReference()
+        if ref is None or ref.network is not None:
             return None
-        return cmd
+        return ref.key
+
+
+class PropertyError(Exception):
+    """An OVF property definition that cannot be evaluated"""
+    pass
+
+
+class PropertyEvaluator(object):
+    """Evaluates the OVF environment properties of the entities.
+
+    Values are computed once and memoized. While a value is computed,
+    the values it reads (deployment parameters and properties of the
+    parent) are recorded, so a changed deployment parameter only
+    invalidates the values that depend on it.
+
+    Nodes of the dependency graph are ("param", deployParams, key),
+    ("prop", entity, key) and ("env", entity) tuples.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.dependents = {}  # node -> nodes computed from it
+        self.computing = []
+        self.lock = threading.RLock()
+
+    def evaluate(self, node, compute):
+        with self.lock:
+            if len(self.computing) > 0:
+                self.dependOn(node)
+            if node in self.values:
+                return self.values[node]
+
+            self.computing.append(node)
+            try:
+                value = compute()
+            finally:
+                self.computing.pop()
+            self.values[node] = value
+            return value
+
+    def dependOn(self, node):
+        """Records that the value being computed depends on node"""
+        with self.lock:
+            self.dependents.setdefault(node, set()).add(self.computing[-1])
+
+    def invalidate(self, node):
+        with self.lock:
+            pending = [node]
+            while len(pending) > 0:
+                n = pending.pop()
+                self.values.pop(n, None)
+                pending.extend(self.dependents.pop(n, ()))
+
+    def invalidateEntity(self, entity):
+        """Forgets everything computed for an entity (e.g. it was edited)"""
+        with self.lock:
+            nodes = [n for n in list(self.values) + list(self.dependents)
+                     if n[1] is entity]
+            for node in nodes:
+                self.invalidate(node)
+
+    def paramChanged(self, deployParams, key):
+        self.invalidate(("param", deployParams, key))
+
+    def param(self, deployParams, key):
+        return self.evaluate(("param", deployParams, key),
+                             lambda: deployParams.getParam(key))
+
+    def value(self, entity, key):
+        """Returns the value of the property key defined on entity"""
+        def compute():
+            prop = entity.getProperty(key)
+            deployParams = entity.getDeployParams()
+
+            def lookup(ref):
+                # An assignment refers to a property of the parent
+                parent = entity.parent
+                if parent is None:
+                    return None
+                if parent.getProperty(ref) is None:
+                    # Becomes defined when the parent is edited
+                    self.dependOn(("prop", parent, ref))
+                    return None
+                return self.value(parent, ref)
+
+            if not prop.isMacro():
+                self.param(deployParams, key)
+            return prop.effectiveValue(deployParams, lookup)
+
+        return self.evaluate(("prop", entity, key), compute)
+
+    def env(self, entity):
+        """Returns the OVF environment properties of entity"""
+        def compute():
+            props = {}
+            if entity.parent is not None and entity.isVM():
+                # A VM inherits the properties of the parent, a vApp does not
+                props = dict(self.env(entity.parent))
+            for p in entity.properties:
+                props[p.key] = self.value(entity, p.key)
+            return props
+
+        return self.evaluate(("env", entity), compute)
+
+    def check(self, entities):
+        """Returns the errors of all properties of entities"""
+        errors = []
+        for e in entities:
+            for p in e.properties:
+                try:
+                    self.value(e, p.key)
+                except PropertyError:
+                    msg = str(sys.exc_info()[1])
+                    if msg not in errors:
+                        errors.append(msg)
+        return errors
+
+
+class PropertyKeyIndex(object):
+    """Property keys defined by the entities in the tree of a root.
+
+    Every key is counted once per entity defining it, so the index can be
+    updated in place when a property is defined or deleted, or when a
+    subtree is moved to another root.
+    """
+
+    def __init__(self):
+        self.allKeys = {}
+        self.ipKeys = {}
+        self.userKeys = {}
+        self.defValues = {}  # key -> {entity: default value}
+
+    @classmethod
+    def count(cls, counts, key, delta):
+        n = counts.get(key, 0) + delta
+        if n > 0:
+            counts[key] = n
+        else:
+            counts.pop(key, None)
+
+    def addProperty(self, entity, prop, delta=1):
+        self.count(self.allKeys, prop.key, delta)
+        if prop.isIp():
+            self.count(self.ipKeys, prop.key, delta)
+        if prop.isUserConfigurable():
+            self.count(self.userKeys, prop.key, delta)
+        if len(prop.value) > 0:
+            values = self.defValues.setdefault(prop.key, {})
+            if delta > 0:
+                values[entity] = prop.value
+            else:
+                values.pop(entity, None)
+            if len(values) == 0:
+                del self.defValues[prop.key]
+
+    def removeProperty(self, entity, prop):
+        self.addProperty(entity, prop, -1)
+
+    def addTree(self, entity, delta=1):
+        for e in entity.getAllEntities():
+            for p in e.properties:
+                self.addProperty(e, p, delta)
+
+    def removeTree(self, entity):
+        self.addTree(entity, -1)
+
+    def getDefValues(self):
+        """Returns the default value of every key that has one.
+
+        The definition closest to the root wins.
+        """
+        def precedence(entity):
+            depth = 0
+            while entity.parent is not None:
+                entity = entity.parent
+                depth += 1
+            return (depth, entity.name)
+
+        defValues = {}
+        for key, values in self.defValues.items():
+            entity = min(values, key=precedence)
+            defValues[key] = values[entity]
+        return defValues
 
 
 def XmlToProperty(node):
@@ -147,6 +351,9 @@ def XmlToProperty(node):
 
 class Link(object):
 
+    __slots__ = ("name", "startOrder", "startWait", "stopWait",
+                 "waitForTools")
+
     def __init__(self, name, startOrder=30):
         self.name = name
         self.startOrder = startOrder
@@ -186,9 +393,14 @@ def XmlToLink(node):
 
 class DeployParams(object):
 
-    def __init__(self, allKeys, ipKeys, userKeys, defValues):
+    __slots__ = ("config", "onChange", "fileName", "savedState", "allKeys",
+                 "ipKeys", "userKeys", "allocationPolicy")
+
+    def __init__(self, allKeys, ipKeys, userKeys, defValues, onChange=None):
         self.config = {}
+        self.onChange = onChange  # Called with (self, key)
         self.fileName = None
+        self.savedState = None  # Logical content of fileName
         self.allKeys = allKeys
         self.ipKeys = ipKeys
         self.userKeys = userKeys
@@ -204,7 +416,8 @@ class DeployParams(object):
                 self.config[k] = v
 
     def load(self, fileName):
-        node = ReadXmlDoc(fileName)
+        self.fileName = fileName
+        node = getWorkspaceSession().read(fileName)
         if node is None:
             return
 
@@ -219,7 +432,15 @@ class DeployParams(object):
             if n.value is not None and n.tag in self.config:
                 self.config[n.tag] = n.value.strip()
 
-        self.fileName = fileName
+        self.savedState = (node.attrs.get("allocationPolicy"),
+                           frozenset([(n.tag, (n.value or "").strip())
+                                      for n in node.children]))
+
+    def logicalState(self):
+        return (self.allocationPolicy, frozenset(self.config.items()))
+
+    def isDirty(self):
+        return self.logicalState() != self.savedState
 
     def isFixedIpPolicy(self):
         return self.allocationPolicy == "fixed"
@@ -238,10 +459,14 @@ class DeployParams(object):
         return root
 
     def writeToFile(self, fileName=None):
+        """Writes the parameters, unless the file is up to date"""
         if fileName is None:
             fileName = self.fileName
-        self.asXmlNode().writeToFile(fileName)
+        if fileName == self.fileName and not self.isDirty():
+            return
+        getWorkspaceSession().markDirty(fileName, self.asXmlNode)
         self.fileName = fileName
+        self.savedState = self.logicalState()
 
     def isValidKey(self, key):
         return key in self.config
@@ -251,7 +476,11 @@ class DeployParams(object):
             not (key in self.ipKeys and not self.isFixedIpPolicy())
 
     def setParam(self, key, value):
+        if self.config.get(key) == value:
+            return
         self.config[key] = value
+        if self.onChange is not None:
+            self.onChange(self, key)
 
     def getParam(self, key):
         if key in self.config:
@@ -272,7 +501,8 @@ class DeployParams(object):
     def empty(self):
         return len(self.config) == 0
 
-    def initIpProps(self, isPowerOn):
+    def initIpProps(self, isPowerOn, owner, save=True):
+        """Allocates or releases the IP addresses leased to owner"""
         # Check manual mode
         if self.isFixedIpPolicy() and isPowerOn:
             for key in self.ipKeys:
@@ -281,29 +511,42 @@ class DeployParams(object):
                     sys.exit(1)
             return
 
-        # Clear all IP properties and unreserve IPs
-        ipRange = getVAppsInstance().ipRange
-        for key in self.ipKeys:
-            ipRange.unreserve(self.getParam(key))
-            self.setParam(key, "")
-        self.writeToFile()
-
-        if self.allocationPolicy == "dhcp" or not isPowerOn:
-            return
+        def allocate(leases):
+            # Release all IPs, then allocate new values
+            for key in self.ipKeys:
+                leases.release(owner, key)
+
+            values = {}
+            if self.allocationPolicy != "dhcp" and isPowerOn:
+                for key in self.ipKeys:
+                    values[key] = leases.allocate(owner, key)
+                    if values[key] is None:
+                        print("Error: No IP addresses left in IP pool")
+                        sys.exit(1)
+            return values
+
+        vapps = getVAppsInstance()
+        if save:
+            values = vapps.updateLeases(allocate)
+        else:
+            vapps.leases.read(vapps.ipRange)
+            values = allocate(vapps.leases)
 
-        # Allocate new values
         for key in self.ipKeys:
-            val = ipRange.allocate()
-            if val is None:
-                print("Error: No IP addresses left in IP pool")
-                sys.exit(1)
-            self.setParam(key, val)
-        self.writeToFile()
+            self.setParam(key, values.get(key, ""))
+
+        if save:
+            self.writeToFile()
 
 
 @add_metaclass(ABCMeta)
 class Entity(object):
 
+    __slots__ = ("name", "cfgPath", "dir", "link", "parent", "children",
+                 "properties", "state", "ip", "deployParams", "keyIndex",
+                 "savedState", "savedData", "tag", "appUrlExpression",
+                 "allocationPolicy", "transport", "ovfEnvProps")
+
     def __init__(self, name, cfgPath):
         self.name = name
         self.cfgPath = cfgPath
@@ -315,6 +558,10 @@ class Entity(object):
         self.state = "unknown"
         self.ip = "unknown"
         self.deployParams = None
+        self.keyIndex = None  # Only used on a root
+        self.savedState = None  # Logical content of cfgPath
+        # Marshal'ed content as loaded, until compared in update()
+        self.savedData = None
         self.tag = ""
         self.appUrl = ""
         self.allocationPolicy = "fixed"
@@ -332,8 +579,12 @@ class Entity(object):
     def isPoweredOn(self):
         return self.state == "Powered On"
 
-    def load(self):
-        node = ReadXmlDoc(self.cfgPath)
+    def load(self, node=None, data=None):
+        """Loads the entity from node, data (a marshal'ed node) or disk"""
+        if data is not None:
+            node = XmlNodeFromTuple(marshal.loads(data))
+        elif node is None:
+            node = getWorkspaceSession().read(self.cfgPath)
         if node.tag != self.getRootTag():
             print("Error reading", self.cfgPath,
                   "Invalid root element:", node.tag)
@@ -343,6 +594,9 @@ class Entity(object):
         for c in node.children:
             self.loadSection(c)
         self.validate()
+        if data is None:
+            data = marshal.dumps(node.asTuple())
+        self.savedData = data
 
     def loadRootAttributes(self, node):
         self.tag = node.getAttr("tag")
@@ -368,7 +622,18 @@ class Entity(object):
         node = NewXmlNode(self.getRootTag())
         self.writeRootAttributes(node)
         self.writeSections(node)
-        node.writeToFile(self.cfgPath)
+        state = node.snapshot()
+        if self.savedData is not None:
+            saved = XmlNodeFromTuple(marshal.loads(self.savedData))
+            self.savedState = saved.snapshot()
+            self.savedData = None
+        if state != self.savedState:
+            getWorkspaceSession().markDirty(self.cfgPath, lambda: node)
+            self.savedState = state
+            vapps = getVAppsInstance()
+            if vapps is not None:
+                vapps.entityUpdated(self, node)
+        self.invalidateOvfEnvProps()
 
     def writeRootAttributes(self, node):
         if len(self.tag) > 0:
@@ -383,17 +648,30 @@ class Entity(object):
         for p in self.properties:
             node.addChild(p.asXmlNode())
 
+    @property
+    def appUrl(self):
+        return self.appUrlExpression.text
+
+    @appUrl.setter
+    def appUrl(self, appUrl):
+        self.appUrlExpression = CompileExpression(appUrl)
+
     def getExpandedAppUrl(self, props=None):
         if props is None:
             dp = self.getDeployParams()
             props = dp.config
-        expandedAppUrl = self.appUrl
-        for (key, value) in props.items():
-            macro = "${" + key + "}"
-            if self.appUrl.find(macro) >= 0 and value == "":
-                return ""
-            expandedAppUrl = expandedAppUrl.replace("${" + key + "}", value)
-        return expandedAppUrl
+
+        def resolve(ref):
+            if ref.network is None:
+                return props.get(ref.key)
+            if ref.network != "Network":
+                return None
+            (val, found) = getVAppsInstance().ipPool.lookupChildTextNode(
+                ref.key)
+            return val if found else None
+
+        # An unset reference blanks the URL, since it would not work anyway
+        return self.appUrlExpression.expand(resolve, blankIfEmpty=True)
 
     def validate(self):
         pass
@@ -403,9 +681,11 @@ class Entity(object):
             return
 
         if self.parent is not None:
+            self.getRoot().updateKeyIndex(lambda index: index.removeTree(self))
             self.parent.children.remove(self)
         self.parent = None
         self.link = None
+        self.invalidateOvfEnvProps()
 
     def setParent(self, parent):
         if self.parent == parent:
@@ -414,43 +694,130 @@ class Entity(object):
         if self.parent is not None:
             self.unsetParent()
 
+        # The keys move to the index of the new root
+        self.keyIndex = None
+        self.resetDeployParams()
+
         link = Link(parent.name)
         self.parent = parent
         self.link = link
         parent.children.append(self)
+        self.getRoot().updateKeyIndex(lambda index: index.addTree(self))
+        self.invalidateOvfEnvProps()
+
+    def getRoot(self):
+        root = self
+        while root.parent is not None:
+            root = root.parent
+        return root
 
-    def removeDir(self):
-        OsTryRemove(os.path.join(self.dir, "deploy.cfg"))
+    def getKeyIndex(self):
+        root = self.getRoot()
+        if root.keyIndex is None:
+            root.keyIndex = PropertyKeyIndex()
+            root.keyIndex.addTree(root)
+        return root.keyIndex
+
+    def updateKeyIndex(self, func):
+        """Applies func to the key index of the root (if it is in use)"""
+        root = self.getRoot()
+        if root.keyIndex is None:
+            return
+        func(root.keyIndex)
+        # Deployment parameters are created for the set of keys
+        root.resetDeployParams()
+
+    def resetDeployParams(self):
+        deployParams = self.deployParams
+        self.deployParams = None
+        if deployParams is not None and deployParams.onChange is not None:
+            for key in list(deployParams.config):
+                deployParams.onChange(deployParams, key)
+
+    def setProperty(self, prop):
+        """Adds prop, or replaces the property with the same key"""
+        old = self.getProperty(prop.key)
+        if old is None:
+            self.properties.append(prop)
+        else:
+            self.properties[self.properties.index(old)] = prop
+
+        def update(index):
+            if old is not None:
+                index.removeProperty(self, old)
+            index.addProperty(self, prop)
+
+        self.updateKeyIndex(update)
+        self.invalidateOvfEnvProps()
+
+    def removeProperty(self, key):
+        prop = self.getProperty(key)
+        if prop is None:
+            return False
+        self.properties.remove(prop)
+        self.updateKeyIndex(lambda index: index.removeProperty(self, prop))
+        self.invalidateOvfEnvProps()
+        return True
+
+    def removeDir(self, toTrash=False):
+        """Deletes the files, or moves them to the trash.
+
+        Either way, only the files owned by the entity go, and its
+        directory is left if other files remain in it.
+        """
+        session = getWorkspaceSession()
+        deployCfgFile = os.path.join(self.dir, "deploy.cfg")
+        session.discard(deployCfgFile)
         removeList = []
         self.getUsedFiles(removeList)
-        OsFileListRemove(removeList)
+        for name, _ in removeList:
+            session.discard(name)
 
-    def getUsedFiles(self, usedList):
-        if self.parent is None:
-            usedList.append((os.path.realpath(os.path.join(self.dir,
-                                                           "deploy.cfg")),
-                             False))
-        usedList.append((os.path.realpath(self.cfgPath), False))
-        usedList.append((os.path.realpath(self.dir), True))
-
-    def getPropKeys(self):
-        _all = set([p.key for p in self.properties])
-        user = set([p.key for p in self.properties if p.isUserConfigurable()])
-        ip = set([p.key for p in self.properties if p.isIp()])
-        defValues = {}
+        if toTrash:
+            self.moveToTrash()
+            return
 
-        for e in self.children:
-            (a, _, _, df) = e.getPropKeys()
-            _all = _all.union(a)
-            user = user.union(user)
-            ip = ip.union(ip)
-            defValues.update(df)
+        OsTryRemove(deployCfgFile)
+        OsFileListRemove(removeList)
 
-        for p in self.properties:
-            if len(p.value) > 0:
-                defValues[p.key] = p.value
+    def moveToTrash(self):
+        """Moves the owned files and trees to a directory of the trash"""
+        vapps = getVAppsInstance()
+        trashDir = os.path.join(vapps.trashDir, "%s.%d.%d" %
+                                (self.name, time.time(), os.getpid()))
+        files, trees = self.getOwnedFiles()
+        # Trees first, as they can hold some of the files
+        paths = trees + [name for name, isDir in files if not isDir]
+        for path in paths:
+            if not os.path.lexists(path):
+                continue
+            relPath = os.path.relpath(path, self.dir)
+            if relPath.startswith(os.pardir):
+                relPath = os.path.basename(path)
+            dest = os.path.normpath(os.path.join(trashDir, relPath))
+            OsMkdirs(os.path.dirname(dest))
+            os.rename(path, dest)
+            vapps.trashUpdated = True
+
+        for name, isDir in files:
+            if isDir:
+                OsTryRmdir(name)
 
-        return (_all, ip, user, defValues)
+    def getUsedFiles(self, usedList):
+        files, trees = self.getOwnedFiles()
+        for t in trees:
+            usedList += OsFileList(t)
+        usedList += files
+
+    def getOwnedFiles(self):
+        """Returns the (path, isDir) of the files, and the directories
+        owned with all their content"""
+        files = []
+        if self.parent is None:
+            files.append((os.path.join(self.dir, "deploy.cfg"), False))
+        files.append((self.cfgPath, False))
+        files.append((self.dir, True))
+        return (files, [])
 
     def getDeployParams(self):
 
@@ -460,56 +827,88 @@ class Entity(object):
         if self.deployParams is not None:
             return self.deployParams
 
-        (allKeys, ipKeys, userKeys, defValues) = self.getPropKeys()
-        self.deployParams = DeployParams(allKeys, ipKeys, userKeys, defValues)
+        index = self.getKeyIndex()
+        evaluator = getVAppsInstance().evaluator
+        self.deployParams = DeployParams(index.allKeys, index.ipKeys,
+                                         index.userKeys, index.getDefValues(),
+                                         evaluator.paramChanged)
 
         deployCfgFile = os.path.join(self.dir, "deploy.cfg")
         self.deployParams.load(deployCfgFile)
-        # We always write it again, since set of properties might have changed
+        # Brings the file up to date if the set of properties has changed
         self.deployParams.writeToFile(deployCfgFile)
 
         return self.deployParams
 
+    def getProperty(self, key):
+        for p in self.properties:
+            if p.key == key:
+                return p
+        return None
+
     def computeOvfEnvProps(self):
-        deployParams = self.getDeployParams()
+        try:
+            props = getVAppsInstance().evaluator.env(self)
+        except PropertyError:
+            print("Error:", sys.exc_info()[1])
+            sys.exit(1)
 
-        parentProps = {}
-        props = {}
+        self.ovfEnvProps = props
+        return props
 
-        if self.parent is not None:
-            self.parent.computeOvfEnvProps()
-            parentProps = self.parent.ovfEnvProps
-            if self.isVM():
-                # A VM inherits the properties of the parent, a vApp does not
-                props = dict(parentProps)
+    def invalidateOvfEnvProps(self):
+        vapps = getVAppsInstance()
+        if vapps is not None:  # Nothing is evaluated while loading
+            vapps.evaluator.invalidateEntity(self)
 
-        for p in self.properties:
-            props[p.key] = p.effectiveValue(deployParams.config, parentProps)
+    def checkOvfEnvProps(self):
+        """Reports all errors in the properties needed to start the entity.
 
-        self.ovfEnvProps = props
-        return props
+        This is done up front, so a start does not fail half way through.
+        """
+        # The environment of a VM includes the environments of its siblings
+        if self.isVM() and self.parent is not None:
+            entities = list(self.parent.children)
+        else:
+            entities = self.getAllEntities()
+
+        ancestor = self.parent
+        while ancestor is not None:
+            entities.append(ancestor)
+            ancestor = ancestor.parent
+
+        errors = getVAppsInstance().evaluator.check(entities)
+        for error in errors:
+            print("Error:", error)
+        if len(errors) > 0:
+            sys.exit(1)
 
     def showOvfEnvProps(self, indent=0):
         if not GetCmdOption("v", False):
             return
 
+        # A single print, so the output of VMs started concurrently does
+        # not get mixed up
         spc = " " * indent
-        for key, value in self.ovfEnvProps.items():
-            print(spc + "  [" + key, "=", value + "]")
+        lines = [spc + "  [%s = %s]" % (key, value)
+                 for key, value in self.ovfEnvProps.items()]
+        if len(lines) > 0:
+            print("\n".join(lines))
 
     def getUsedIPs(self):
+        """Returns the key -> IP address map of the IP properties in use"""
         deployParam = self.getDeployParams()
         if self.state == "Powered Off" and not deployParam.isFixedIpPolicy():
-            return set()
+            return {}
 
-        usedIps = set()
+        usedIps = {}
         ipProps = [p for p in self.properties if p.isIp()]
         for p in ipProps:
             val = deployParam.getParam(p.key)
             if val == "":
                 val = p.value
             if val != "":
-                usedIps.add(val)
+                usedIps[p.key] = val
         return usedIps
 
     def propagateIp(self, ip, keysIn=None):
@@ -520,7 +919,7 @@ class Entity(object):
         for p in self.properties:
             # If an IP value exists, we update the property with the IP address
             if p.isIp() and (len(keysIn) == 0 or p.key in keysIn):
-                val = p.effectiveValue(deployParam.config)
+                val = p.effectiveValue(deployParam)
                 if val == "":
                     deployParam.setParam(p.key, ip)
                     deployParam.writeToFile()
@@ -540,13 +939,42 @@ class Entity(object):
             return self.parent.inRunningVApp()
         return False
 
+    def startFailed(self):
+        """Releases the IPs allocated for a start that failed, unless
+        some VM of the vApp is running, and exits"""
+        self.initPowerState()
+        self.setupIpProperties(False)
+        sys.exit(1)
+
     def setupIpProperties(self, powerOn):
         if not self.inRunningVApp():
-            self.getDeployParams().initIpProps(powerOn)
+            # A dry run only shows the addresses that would be used
+            self.getDeployParams().initIpProps(
+                powerOn, self.getRoot().name,
+                save=not GetCmdOption("n", False))
+
+    def getAllEntities(self):
+        entities = [self]
+        for c in self.children:
+            entities += c.getAllEntities()
+        return entities
+
+    def getAllVms(self):
+        vms = []
+        if self.isVM():
+            vms.append(self)
+        for c in self.children:
+            vms += c.getAllVms()
+        return vms
+
+    def updatePowerState(self):
+        pass
 
 
 class VmEntity(Entity):
 
+    __slots__ = ("vmxFile",)
+
     def __init__(self, name, cfgPath):
         Entity.__init__(self, name, cfgPath)
         self.vmxFile = ""
@@ -594,10 +1022,14 @@ class VmEntity(Entity):
             print("Error: Already running")
             return
 
+        self.checkOvfEnvProps()
         self.setupIpProperties(True)
-        self.startChild()
+        # The allocated IPs are saved before any VM is powered on
+        getWorkspaceSession().commit()
+        if not self.startChild():
+            self.startFailed()
 
-    def startChild(self, indent=0):
+    def startChild(self, indent=0, renderer=None):
         vmrun = getVmrunInstance()
 
         # Update OVF environment for this VM
@@ -609,40 +1041,43 @@ class VmEntity(Entity):
             vappEnv[self.name] = self.ovfEnvProps
         else:
             for c in self.parent.children:
-                vappEnv[c.name] = c.ovfEnvProps
+                vappEnv[c.name] = c.computeOvfEnvProps()
 
-        ovfEnv = OvfEnv(self.name, vappEnv)
-        vmrun.patchVmxFile(self.vmxFile, ovfEnv, self.transport)
+        ovfEnv = OvfEnv(self.name, vappEnv, renderer)
+        vmrun.patchVmxFile(self.vmxFile, ovfEnv, self.transport,
+                           getVAppsInstance().isoCache)
 
         spc = " " * indent
-        print(spc + "Starting", self.name)
+        print(spc + "Starting " + self.name)
         self.showOvfEnvProps(indent)
 
         if GetCmdOption("n", False):
-            return
+            return True
 
-        vmrun.powerOn(self.vmxFile)
+        if not vmrun.powerOn(self.vmxFile):
+            print("Error: Failed to power on " + self.name)
+            return False
 
         # If it is a single VM, we are done
         if self.link is None:
-            return
+            return True
 
-        waited = 0
-        while waited < self.link.startWait:
-            time.sleep(1)
-            if waited % 10 == 0:
-                print(spc + "Waiting for %d secs..." %
-                      (self.link.startWait - waited))
-            waited += 1
-            if self.link.waitForTools:
-                ip = vmrun.getIP(self.vmxFile)
-                if len(ip) > 0:
-                    print(spc + "(ip: %s)" % ip)
-                    # Propagate IP up in OVF environment (dhcp policy)
-                    dp = self.getDeployParams()
-                    if dp.isDhcpPolicy():
-                        self.propagateIp(ip)
-                    return
+        startWait = self.link.startWait
+        if not self.link.waitForTools:
+            print(spc + "Waiting %d secs for %s..." % (startWait, self.name))
+            time.sleep(startWait)
+            return True
+
+        print(spc + "Waiting up to %d secs for %s..." % (startWait, self.name))
+        ip = vmrun.waitForGuestIp(self.vmxFile, startWait)
+        if len(ip) > 0:
+            print(spc + "(%s ip: %s)" % (self.name, ip))
+            # Propagate IP up in OVF environment (dhcp policy)
+            with deployParamsLock:
+                dp = self.getDeployParams()
+                if dp.isDhcpPolicy():
+                    self.propagateIp(ip)
+        return True
 
     def stopAction(self, indent=0, force=False, silentFail=False):
         self.initPowerState()
@@ -653,19 +1088,46 @@ class VmEntity(Entity):
 
         spc = " " * indent
         if not force:
-            print(spc + "Stopping", self.name)
+            print(spc + "Stopping " + self.name)
         else:
-            print(spc + "Shutting down", self.name)
+            print(spc + "Shutting down " + self.name)
 
         if GetCmdOption("n", False):
             return
 
         vmrun = getVmrunInstance()
-        vmrun.powerOff(self.vmxFile, force)
+        started = time.time()
+        if force:
+            stopped = vmrun.powerOff(self.vmxFile, hard=True)
+        else:
+            stopWait = None
+            if self.link is not None:
+                stopWait = self.link.stopWait
+            stopped = vmrun.powerOff(self.vmxFile, timeout=stopWait)
+            if not stopped:
+                # A soft stop that fails before stopWait is over (e.g. the
+                # tools are not running) is not reported as a timeout
+                if stopWait is not None and \
+                   time.time() - started >= stopWait:
+                    print(spc + "%s did not stop within %d secs, "
+                          "powering off" % (self.name, stopWait))
+                else:
+                    print(spc + "%s failed to stop, powering off" %
+                          self.name)
+                stopped = vmrun.powerOff(self.vmxFile, hard=True)
+        if not stopped:
+            # The VM may still be running, so its IPs stay leased
+            print("Error: Failed to stop " + self.name)
+            self.initPowerState()
+            return
+
+        print(spc + "(%s stopped in %.1f secs)" %
+              (self.name, time.time() - started))
 
         # Re-initialize power state and reset transient properties
         self.initPowerState()
-        self.setupIpProperties(False)
+        with deployParamsLock:
+            self.setupIpProperties(False)
 
         # Disconnect OVF iso (so VM can be exported)
         vmrun.disconnectOvfIsoInVmx(self.vmxFile, self.transport)
@@ -673,12 +1135,14 @@ class VmEntity(Entity):
     def shutdownAction(self, indent=0):
         self.stopAction(indent, force=True, silentFail=True)
 
-    def getUsedFiles(self, usedList):
-        usedList.append((os.path.join(self.dir, "ovf-env.iso"), False))
-        usedList.append((os.path.join(self.dir, "ovf-env.xml"), False))
+    def getOwnedFiles(self):
+        (files, trees) = Entity.getOwnedFiles(self)
+        files[:0] = [(os.path.join(self.dir, "ovf-env.iso"), False),
+                     (os.path.join(self.dir, "ovf-env.xml"), False),
+                     (os.path.join(self.dir, "ovf-env.hash"), False)]
         if self.isVmxInSubdir():
-            usedList += OsFileList(os.path.dirname(self.vmxFile))
-        Entity.getUsedFiles(self, usedList)
+            trees.append(os.path.dirname(self.vmxFile))
+        return (files, trees)
 
     def isVmxInSubdir(self):
         d1 = os.path.realpath(self.dir)
@@ -690,8 +1154,19 @@ class VmEntity(Entity):
         (self.state, self.ip) = vmrun.getPowerStateAndIp(self.vmxFile)
 
 
+def probePowerStates(vms, withIp=True):
+    """Probes the power state of all VMs concurrently"""
+    vmrun = getVmrunInstance()
+    states = vmrun.getPowerStatesAndIps([vm.vmxFile for vm in vms], withIp)
+    for vm, (state, ip) in zip(vms, states):
+        vm.state = state
+        vm.ip = ip
+
+
 class VAppEntity(Entity):
 
+    __slots__ = ()
+
     def __init__(self, name, cfgPath):
         Entity.__init__(self, name, cfgPath)
 
@@ -706,25 +1181,16 @@ class VAppEntity(Entity):
     def validate(self):
         pass
 
-    def getLinks(self):
-        return self.links
-
-    def setLinks(self, links):
-        self.links = links
-
-    def removeLink(self, name):
-        if name in self.links:
-            self.links.pop(name)
-
-    def addLink(self, name, startOrder):
-        link = Link(name, startOrder)
-        self.links[name] = link
-
     def initPowerState(self):
+        probePowerStates(self.getAllVms())
+        self.updatePowerState()
+
+    def updatePowerState(self):
+        # Derived from the children, so they must be probed first
         self.ip = ""
         self.state = "Powered Off"
         for c in self.children:
-            c.initPowerState()
+            c.updatePowerState()
             if c.state == "Powered On":
                 self.state = "Powered On"
 
@@ -742,10 +1208,14 @@ class VAppEntity(Entity):
             print("Error: Already running")
             return
 
+        self.checkOvfEnvProps()
         self.setupIpProperties(True)
-        self.startChild()
+        # The allocated IPs are saved before any VM is powered on
+        getWorkspaceSession().commit()
+        if not self.startChild():
+            self.startFailed()
 
-    def startChild(self, indent=0):
+    def startChild(self, indent=0, renderer=None):
 
         self.computeOvfEnvProps()
         # An OVF environment for a VM also contains the OVF environments
@@ -754,12 +1224,31 @@ class VAppEntity(Entity):
             c.computeOvfEnvProps()
 
         spc = " " * indent
-        print(spc + "Starting", self.name)
+        print(spc + "Starting " + self.name)
         self.showOvfEnvProps()
 
-        startItems = sorted(self.children, key=lambda x: x.link.startOrder)
-        for c in startItems:
-            c.startChild(indent + 1)
+        # Children with the same startOrder are started together, and the
+        # next group is only started once all of them are up (or timed out).
+        # Each member gets its own thread, as they mostly wait on the
+        # guests, so VAPPRUN_WORKERS does not apply.
+        def startOrder(entity):
+            return entity.link.startOrder
+
+        # The property sections of the siblings are rendered once for the
+        # OVF environments of all VMs in the vApp
+        if renderer is None:
+            renderer = OvfEnvRenderer()
+
+        startItems = sorted(self.children, key=startOrder)
+        for _, group in groupby(startItems, key=startOrder):
+            group = list(group)
+            started = ParallelMap(lambda c: c.startChild(indent + 1,
+                                                         renderer),
+                                  group, workers=len(group))
+            if not all(started):
+                print("Error: Not starting the rest of " + self.name)
+                return False
+        return True
 
     def stopAction(self, indent=0, force=False, silentFail=False):
         self.initPowerState()
@@ -770,14 +1259,21 @@ class VAppEntity(Entity):
 
         spc = " " * indent
         if not force:
-            print(spc + "Stopping", self.name)
+            print(spc + "Stopping " + self.name)
         else:
-            print(spc + "Shutting down", self.name)
+            print(spc + "Shutting down " + self.name)
 
-        stopItems = sorted(self.children, key=lambda x: x.link.startOrder)
-        stopItems.reverse()
-        for c in stopItems:
-            c.stopAction(indent + 1, force, silentFail=True)
+        # Groups are stopped in reverse startOrder, the members of a group
+        # concurrently, each in its own thread
+        def startOrder(entity):
+            return entity.link.startOrder
+
+        stopItems = sorted(self.children, key=startOrder, reverse=True)
+        for _, group in groupby(stopItems, key=startOrder):
+            group = list(group)
+            ParallelMap(lambda c: c.stopAction(indent + 1, force,
+                                               silentFail=True), group,
+                        workers=len(group))
 
         self.initPowerState()
         self.setupIpProperties(False)
@@ -786,9 +1282,128 @@ class VAppEntity(Entity):
         self.stopAction(indent, force=True)
 
 
+class InventorySnapshot(object):
+    """The parsed entity configurations of a workspace, kept between runs.
+
+    The list of entries is reused while the workspace directory is not
+    modified, and an entry while its configuration file has the same
+    modification time and size. Anything else is parsed again. Set
+    VAPPRUN_INVENTORY_CACHE=0 to always parse everything.
+
+    The parent of every entity is recorded too, so the tree of a single
+    entity can be found without looking at the others.
+    """
+
+    VERSION = 2
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.enabled = GetEnvOption("INVENTORY_CACHE", "1") != "0"
+        self.dirStamp = ""
+        # Name -> (cfg file name or None, stamp, marshal'ed node tuple,
+        #          parent name)
+        self.entries = {}
+        self.changed = False
+        if self.enabled:
+            self.read()
+
+    def read(self):
+        try:
+            with open(self.fileName, "rb") as f:
+                data = f.read()
+            (version, dirStamp, entries) = marshal.loads(data)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return
+        if version == self.VERSION:
+            self.dirStamp = dirStamp
+            self.entries = entries
+
+    def isCurrent(self, dirname):
+        return self.enabled and FileStamp(dirname) == self.dirStamp
+
+    def listNames(self, dirname):
+        stamp = FileStamp(dirname)
+        if stamp == self.dirStamp:
+            return list(self.entries)
+
+        # Entities are directories. Dot entries (e.g. .cache, which holds
+        # the snapshot itself) and plain files change on their own, so
+        # recording them would make every run write the snapshot again.
+        names = [n for n in os.listdir(dirname)
+                 if not n.startswith(".") and
+                 os.path.isdir(os.path.join(dirname, n))]
+        self.dirStamp = stamp
+        self.entries = dict([(n, self.entries[n]) for n in names
+                             if n in self.entries])
+        self.changed = True
+        return names
+
+    def getTree(self, name):
+        """Returns the names in the tree the entity name belongs to"""
+        parents = dict([(n, e[3]) for n, e in self.entries.items()
+                        if e[0] is not None])
+        if name not in parents:
+            return []
+
+        root = name
+        seen = set([root])
+        while parents[root] in parents and parents[root] not in seen:
+            root = parents[root]
+            seen.add(root)
+
+        children = {}
+        for n, parent in parents.items():
+            if parent is not None:
+                children.setdefault(parent, []).append(n)
+
+        tree = [root]
+        for n in tree:
+            tree += [c for c in children.get(n, []) if c not in tree]
+        return tree
+
+    def lookup(self, name, path):
+        """Returns the (cfg file name, marshal'ed node) of a valid entry"""
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+
+        (cfgName, stamp, data, _) = entry
+        if cfgName is not None:
+            path = os.path.join(path, cfgName)
+        if FileStamp(path) != stamp:
+            return None
+        return (cfgName, data)
+
+    def store(self, name, cfgName, stamp, node):
+        """Records node and returns it marshal'ed"""
+        parent = None
+        if node is not None:
+            link = node.lookup("link")
+            if link is not None:
+                parent = link.getAttr("name")
+            node = marshal.dumps(node.asTuple())
+        self.entries[name] = (cfgName, stamp, node, parent)
+        self.changed = True
+        return node
+
+    def save(self):
+        if not self.enabled or not self.changed:
+            return
+        data = marshal.dumps((self.VERSION, self.dirStamp, self.entries))
+        OsMkdirs(os.path.dirname(self.fileName))
+        AtomicWriteFile(self.fileName, data, syncDir=False)
+        self.changed = False
+
+
 class VAppInventory(object):
+    """The entities of a workspace.
+
+    A lazy inventory only loads the trees of the entities that are looked
+    up with getEntity. Entities edited outside of vapprun so that they
+    join such a tree are only seen by a full load (e.g. list or fsck).
+    """
 
-    def __init__(self, path):
+    def __init__(self, path, lazy=False):
         self.dir = os.path.realpath(path)
         self.cfgFile = os.path.realpath(os.path.join(self.dir,
                                                      WORKSPACE_CFG_NAME))
@@ -814,27 +1429,67 @@ class VAppInventory(object):
             self.ipPool = NewXmlNode("ipPool")
 
         r, _ = self.ipPool.lookupChildTextNode("range")
-        self.ipRange = CreateIpPool(r)
-        self.loadInventory()
+        try:
+            self.ipRange = CreateIpPool(r)
+        except IpRangeError:
+            # Not fatal, so the range can still be changed with the
+            # workspace command
+            print("Error:", sys.exc_info()[1])
+            self.ipRange = IpPool([])
+        self.evaluator = PropertyEvaluator()
+        self.cacheDir = os.path.join(self.dir, CACHE_DIR_NAME)
+        self.isoCache = OvfEnvIsoCache(os.path.join(self.cacheDir, "ovfenv"))
+        self.trashDir = os.path.join(self.dir, TRASH_DIR_NAME)
+        self.trashUpdated = False  # Files were moved to the trash
+        self.leases = IpLeaseDatabase(
+            os.path.join(self.dir, LEASES_CFG_NAME),
+            os.path.join(self.dir, LEASES_LOCK_NAME))
 
-    def loadInventory(self):
         self.entities = {}
         self.roots = []
-        for name in os.listdir(self.dir):
+        self.updated = {}  # Name -> (entity, node) of updated entities
+        self.snapshot = InventorySnapshot(os.path.join(self.cacheDir,
+                                                       "inventory"))
+        # A lazy load needs the parents of the snapshot
+        self.lazy = lazy and self.snapshot.isCurrent(self.dir) and \
+            self.leases.exists()
+        if not self.lazy:
+            self.loadInventory()
+
+    def loadInventory(self):
+        loaded = []
+        for name in self.snapshot.listNames(self.dir):
             e = self.loadEntity(name)
-            if e is None:
-                continue
-            self.entities[name] = e
+            if e is not None:
+                loaded.append(e)
+        self.addEntities(loaded)
+        self.snapshot.save()
+
+    def loadTree(self, name):
+        loaded = []
+        for n in self.snapshot.getTree(name):
+            if n not in self.entities:
+                e = self.loadEntity(n)
+                if e is not None:
+                    loaded.append(e)
+        self.addEntities(loaded)
+
+    def addEntities(self, loaded):
+        for e in loaded:
+            self.entities[e.name] = e
             if e.link is None:
                 self.roots.append(e)
 
         # Setup/fixup child/parent relationships
-        for name, child in self.entities.items():
+        for child in loaded:
             link = child.link
             if link is None:
                 continue
 
             parentName = link.name
+            if self.lazy and parentName not in self.entities:
+                # The entity was moved to another tree
+                self.loadTree(parentName)
             if parentName in self.entities:
                 parent = self.entities[parentName]
                 parent.children.append(child)
@@ -844,33 +1499,88 @@ class VAppInventory(object):
                 child.update()  # Update on disk
 
     def loadEntity(self, name):
+        snapshot = self.snapshot
         dirname = os.path.join(self.dir, name)
-        vmPath = os.path.join(dirname, VM_CFG_NAME)
-        vappPath = os.path.join(dirname, VAPP_CFG_NAME)
-        if os.path.exists(vmPath):
-            entity = VmEntity(name, vmPath)
-            entity.load()
-            return entity
-        elif os.path.exists(vappPath):
-            entity = VAppEntity(name, vappPath)
-            entity.load()
-            return entity
+        cached = snapshot.lookup(name, dirname)
+        if cached is not None:
+            (cfgName, data) = cached
         else:
+            cfgName = None
+            for c in [VM_CFG_NAME, VAPP_CFG_NAME]:
+                if os.path.exists(os.path.join(dirname, c)):
+                    cfgName = c
+                    break
+
+            if cfgName is None:
+                # Remember it is no entity until something is added
+                snapshot.store(name, None, FileStamp(dirname), None)
+                return None
+
+            cfgPath = os.path.join(dirname, cfgName)
+            stamp = FileStamp(cfgPath)
+            node = getWorkspaceSession().read(cfgPath)
+            data = snapshot.store(name, cfgName, stamp, node)
+
+        if cfgName is None:
             return None
+        elif cfgName == VM_CFG_NAME:
+            entity = VmEntity(name, os.path.join(dirname, cfgName))
+        else:
+            entity = VAppEntity(name, os.path.join(dirname, cfgName))
+        entity.load(data=data)
+        return entity
+
+    def getEntity(self, name):
+        """Returns the entity called name, or None if there is none"""
+        if self.lazy and name not in self.entities:
+            self.loadTree(name)
+        return self.entities.get(name)
+
+    def entityUpdated(self, entity, node):
+        self.updated[entity.name] = (entity, node)
+
+    def commit(self):
+        """Saves the changes made by a command"""
+        getWorkspaceSession().commit()
+
+        # Written configurations need not be parsed again
+        for name, (entity, node) in self.updated.items():
+            stamp = FileStamp(entity.cfgPath)
+            if stamp != "":
+                self.snapshot.store(name, os.path.basename(entity.cfgPath),
+                                    stamp, node)
+        self.updated = {}
+        self.snapshot.save()
 
     def updateWorkspaceConfig(self):
         node = NewXmlNode("vapprun")\
             .setAttr("configVersion", VAPPRUN_CONFIG_VERSION)\
             .addChild(self.ipPool)
-        node.writeToFile(WORKSPACE_CFG_NAME)
+        getWorkspaceSession().markDirty(self.cfgFile, lambda: node)
 
-    def initPowerState(self):
+    def initPowerState(self, withIp=True):
+        vms = [e for e in self.entities.values() if e.isVM()]
+        probePowerStates(vms, withIp)
         for e in self.roots:
-            e.initPowerState()
+            e.updatePowerState()
 
-        # Power state must be initialized for this to work properly
+    def updateLeases(self, func):
+        """Applies func to the IP leases, under the lease file lock"""
+        return self.leases.update(self.ipRange, func)
+
+    def reconcileLeases(self):
+        """Rebuilds the IP leases from the addresses in use.
+
+        This probes the power state of all the VMs, so it is only done
+        on demand. It must not be called on a lazy inventory.
+        """
+        self.initPowerState(withIp=False)
+        used = {}
         for e in self.entities.values():
-            self.ipRange.reserve(e.getUsedIPs())
+            owner = e.getRoot().name
+            for key, ip in e.getUsedIPs().items():
+                used[(owner, key)] = ip
+        self.updateLeases(lambda leases: leases.replace(used))
 
 
 def createNewWorkspace():
@@ -887,15 +1597,19 @@ def createNewWorkspace():
             .addXmlTextNode("httpProxy", "")
             .addXmlTextNode("range", "192.168.0.200#8"))
     node.writeToFile(WORKSPACE_CFG_NAME)
+    IpLeaseDatabase(LEASES_CFG_NAME, LEASES_LOCK_NAME).write()
 
 
-def initializeVAppInventory():
+def initializeVAppInventory(lazy=False):
     global vappsInstance
     wsDir = locateVAppsDirectory()
     if wsDir == "":
         vappsInstance = None
     else:
-        vappsInstance = VAppInventory(wsDir)
+        vappsInstance = VAppInventory(wsDir, lazy)
+        if not vappsInstance.leases.exists():
+            # Record the addresses in use when upgrading a workspace
+            vappsInstance.reconcileLeases()
 
     return vappsInstance
 
@@ -904,6 +1618,45 @@ def getVAppsInstance():
     return vappsInstance
 
 
+def getWorkspaceSession():
+    return sessionInstance
+
+
+def purgeTrash(wsDir):
+    """Deletes the directories in the trash of a workspace. Returns how many.
+
+    The files are deleted in parallel. Concurrent purges wait for each
+    other, and an interrupted purge is finished by the next one. The
+    inventory is not loaded, so entities that cannot be loaded do not
+    keep the trash from being purged.
+    """
+    trashDir = os.path.join(wsDir, TRASH_DIR_NAME)
+    if not os.path.isdir(trashDir):
+        return 0
+
+    purged = 0
+    with FileLock(os.path.join(trashDir, TRASH_LOCK_NAME)):
+        for name in os.listdir(trashDir):
+            if name == TRASH_LOCK_NAME:
+                continue
+            path = os.path.join(trashDir, name)
+            files = []
+            dirs = []
+            for root, dirnames, filenames in os.walk(path, topdown=False):
+                files += [os.path.join(root, f) for f in filenames]
+                # Links to directories are not walked into
+                files += [os.path.join(root, d) for d in dirnames
+                          if os.path.islink(os.path.join(root, d))]
+                dirs.append(root)
+            ParallelMap(OsTryRemove, files)
+            for d in dirs:
+                OsTryRmdir(d)
+            if not os.path.isdir(path):
+                OsTryRemove(path)
+            purged += 1
+    return purged
+
+
 def locateVAppsDirectory():
     curdir = os.path.abspath(".")
     while True:
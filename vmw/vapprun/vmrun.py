@@ -15,19 +15,33 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import hashlib
+import io
 import os
+import re
+import shutil
 import string
 import subprocess
 import sys
+import threading
+import time
+from abc import ABCMeta, abstractmethod
 
 from pkg_resources import ResourceManager, get_provider
+from six import add_metaclass
 
 from .commands import VDISKMANAGER_CMD, VMRUN_CMD
-from .utils import (CreateRelPath, GetCmdOption, OsMkdirs, OsTryRemove,
-                    OsTryRmdir, WriteTxtFile)
+from .ovfenv import IsoImage
+from .utils import (AtomicWriteFile, CreateRelPath, FileStamp, GetCmdOption,
+                    GetEnvOption, OsMkdirs, OsReplace, OsTryRemove,
+                    OsTryRmdir, ParallelMap, WriteTxtFile)
 
 vmrunInstance = None
 
+# Bounds (in seconds) of the interval used when polling a guest
+MIN_POLL_DELAY = 0.5
+MAX_POLL_DELAY = 4
+
 # See http://www.py2exe.org/index.cgi/Py2ExeSubprocessInteractions
 # This does not adversely affect vapprun behavior.
 if sys.platform.startswith('win'):
@@ -38,77 +52,96 @@ else:
 
 def initializeVmrunInstance():
     global vmrunInstance
-    vmrunInstance = VmrunCommand()
+    backend = GetEnvOption("BACKEND", "vmrun")
+    if backend == "vmrun":
+        vmrunInstance = VmrunCommand()
+    elif backend == "simulator":
+        from .simulator import SimulatorBackend
+        vmrunInstance = SimulatorBackend()
+    else:
+        print("Error: Unknown backend:", backend)
+        sys.exit(1)
 
 
 def getVmrunInstance():
     return vmrunInstance
 
 
-class VmrunCommand(object):
+class ProcessTimer(object):
+    """Kills a process that is still running after timeout seconds"""
+
+    def __init__(self, process, timeout):
+        self.process = process
+        self.expired = False
+        self.timer = None
+        if timeout is not None:
+            self.timer = threading.Timer(max(timeout, 0), self.kill)
+            self.timer.start()
+
+    def kill(self):
+        self.expired = True
+        try:
+            self.process.kill()
+        except OSError:
+            pass  # Already exited
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+
+@add_metaclass(ABCMeta)
+class HypervisorBackend(object):
+    """Interface to the hypervisor running the VMs of a workspace.
 
+    Backends implement the primitive operations. The VM and .vmx file
+    handling built on top of them is shared.
+    """
+
+    @abstractmethod
     def powerOn(self, vmxPath):
-        guiOption = "nogui"
-        if GetCmdOption("gui", False):
-            guiOption = "gui"
-        cmd = [VMRUN_CMD, "start", vmxPath, guiOption]
-        self.subprocessCall(cmd)
+        """Powers on a VM. Returns False if that failed"""
+        pass
 
-    def powerOff(self, vmxPath, hard=False):
-        if hard:
-            action = "hard"
-        else:
-            action = "soft"
-        cmd = [VMRUN_CMD, "stop", vmxPath, action]
-        self.subprocessCall(cmd)
+    @abstractmethod
+    def powerOff(self, vmxPath, hard=False, timeout=None):
+        """Powers off a VM. Returns False if that failed.
 
-    @classmethod
-    def subprocessCall(cls, cmd, exitOnFail=True):
-        try:
-            # On Windows, inhibit the console window that
-            # pops up as a result of doing this.
-            if sys.platform.startswith('win'):
-                import win32process
-                opts = {'creationflags': win32process.CREATE_NO_WINDOW}
-            else:
-                opts = {}
-            subprocess.call(cmd, **opts)
-            return True
-        except Exception:
-            print("Error: Failed to execute ", cmd[0], ". Is it in your path?")
-            if exitOnFail:
-                sys.exit(1)
-            return False
+        Waiting for a soft power off is given up after timeout seconds.
+        """
+        pass
 
-        return True
+    @abstractmethod
+    def readRuntimeVariable(self, vmxPath, name):
+        """Returns the lowercased value, or an error message"""
+        pass
 
-    @classmethod
-    def readRuntimeVariable(cls, vmxPath, name):
-        cmd = [VMRUN_CMD,
-               "readVariable",
-               vmxPath,
-               "runtimeConfig",
-               name]
-        # We pipe stdin even though we don't write anything to it,
-        # and use NUL_STDERR (on Windows, an explicit nul-pointing
-        # file handle.) This is to work around issues with py2exe
-        # and does not harm behavior on non-Windows platforms.
-        # Furthermore, on Windows, inhibit the console window that
-        # pops up as a result of doing this.
-        if sys.platform.startswith('win'):
-            import win32process
-            opts = {'creationflags': win32process.CREATE_NO_WINDOW}
-        else:
-            opts = {}
+    @abstractmethod
+    def writeRuntimeVariable(self, vmxPath, name, value):
+        pass
 
-        p = subprocess.Popen(cmd,
-                             stdout=subprocess.PIPE,
-                             stdin=subprocess.PIPE,
-                             stderr=NUL_STDERR,
-                             **opts)
-        out = p.stdout.read().decode('utf-8').strip().lower()
-        p.stdout.close()
-        return out.strip()
+    @abstractmethod
+    def listRunningVms(self):
+        """Returns the normalized .vmx paths of all running VMs.
+
+        None is returned if the running VMs cannot be listed.
+        """
+        pass
+
+    @abstractmethod
+    def createSparseVmdk(self, filename, diskSize):
+        """Creates a disk of diskSize GB. Returns False if that failed"""
+        pass
+
+    def createIsoImage(self, isoFile, label, files):
+        """Creates an ISO image holding files (a name->content map)"""
+        image = IsoImage(label, files).create()
+        with open(isoFile, "wb") as f:
+            f.write(image)
+
+    @classmethod
+    def normalizeVmxPath(cls, vmxPath):
+        return os.path.normcase(os.path.realpath(vmxPath))
 
     def readGuestInfoIp(self, vmxPath):
         return self.readRuntimeVariable(vmxPath, "guestinfo.ip")
@@ -128,6 +161,49 @@ class VmrunCommand(object):
         else:
             return ("Powered On", out)
 
+    def getPowerStatesAndIps(self, vmxPaths, withIp=True):
+        """Batch version of getPowerStateAndIp.
+
+        A single listRunningVms call finds the running VMs, so the
+        guest IP only has to be queried for those, and only if withIp
+        is set.
+        """
+        running = self.listRunningVms()
+        if running is None:
+            return ParallelMap(self.getPowerStateAndIp, vmxPaths)
+
+        result = [("Powered Off", "")] * len(vmxPaths)
+        poweredOn = [i for i, vmxPath in enumerate(vmxPaths)
+                     if self.normalizeVmxPath(vmxPath) in running]
+        if not withIp:
+            for i in poweredOn:
+                result[i] = ("Powered On", "")
+            return result
+
+        states = ParallelMap(lambda i: self.getPowerStateAndIp(vmxPaths[i]),
+                             poweredOn)
+        for i, state in zip(poweredOn, states):
+            result[i] = state
+        return result
+
+    def waitForGuestIp(self, vmxPath, timeout):
+        """Waits until the guest reports an IP address.
+
+        Returns the IP, or "" if none was reported within timeout
+        seconds. The poll interval backs off exponentially.
+        """
+        deadline = time.time() + timeout
+        delay = MIN_POLL_DELAY
+        while True:
+            ip = self.getIP(vmxPath)
+            if len(ip) > 0:
+                return ip
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return ""
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, MAX_POLL_DELAY)
+
     def createVm(self, vmxFile, name, memSize, diskSize):
         dirname = os.path.dirname(vmxFile)
         cleanupList = OsMkdirs(dirname)
@@ -142,17 +218,6 @@ class VmrunCommand(object):
 
         self.createVmxFile(vmxFile, name, memSize, diskFile)
 
-    def createSparseVmdk(self, filename, diskSize):
-        OsTryRemove(filename)
-        cmd = [VDISKMANAGER_CMD,
-               "-c",
-               "-t", "0",              # monoSparse
-               "-s", diskSize + "GB",  # capacity
-               "-a", "lsilogic",       # adapter type
-               filename]
-
-        return self.subprocessCall(cmd, exitOnFail=False)
-
     @classmethod
     def getTemplate(cls, fname):
         current_module = sys.modules[__name__]
@@ -164,7 +229,7 @@ class VmrunCommand(object):
         if not provider.has_resource(p):
             raise Exception("Template not found: %s", fname)
 
-        return provider.get_resource_string(manager, p)
+        return provider.get_resource_string(manager, p).decode('utf-8')
 
     def createVmxFile(self, vmxPath, name, memSize, diskFile):
         vmxTemplateString = self.getTemplate('template.vmx')
@@ -183,94 +248,57 @@ class VmrunCommand(object):
         with open(vmxPath, "w") as vmxFile:
             print(vmx, file=vmxFile)
 
-    @classmethod
-    def vmxEscape(cls, s):
-        escaped = ['#', '|', '\\', '"']
-
-        def escape(c):
-            if c in escaped or ord(c) < 32:
-                return "|%02x" % ord(c)
-            else:
-                return c
+    def detectCdRomDevice(self, vmx):
+        """Returns the CD-ROM device of a VmxDocument to mount the
+        OVF environment on, or None if it has none."""
+        devices = [d for d in vmx.devices() if self.isCdromDevice(vmx, d)]
 
-        return "".join([escape(c) for c in s])
-
-    @classmethod
-    def splitVmxEntry(cls, line):
-        s = line.split("=")
-        if len(s) < 2:
-            return ("", "")
-        return (s[0].strip().lower(), s[1].strip().lower())
-
-    @classmethod
-    def getBoolVmxKey(cls, vmxDict, key, defval=False):
-        if key not in vmxDict:
-            return defval
-        val = vmxDict[key]
-        return val == '"true"' or val == "true"
-
-    @classmethod
-    def getVmxKey(cls, vmxDict, key, defval=""):
-        if key not in vmxDict:
-            return defval
-        return vmxDict[key]
-
-    def readVmxFile(self, vmxFile):
-        vmxDict = {}
-        vmxIn = open(vmxFile, "r")
-        for line in vmxIn:
-            line = line[:-1]  # Drop ending
-            (key, value) = self.splitVmxEntry(line)
-            if key != "":
-                vmxDict[key] = value
-        return vmxDict
-
-    def detectCdRomDevice(self, vmxFile):
-        vmxDict = self.readVmxFile(vmxFile)
-
-        devices = (["ide" + str(x) + ":" + str(y)
-                    for x in range(0, 2) for y in range(0, 2)] +
-                   ["scsi" + str(x) + ":" + str(y)
-                    for x in range(0, 8) for y in range(0, 8)])
-
-        devices = [d for d in devices if self.isCdromDevice(vmxDict, d)]
-
-        candidate = None
         for dev in devices:
-            if self.isMoutingOvfEnvIso(vmxDict, dev):
+            if self.isMountingOvfEnvIso(vmx, dev):
                 return dev
 
-            if candidate is None and self.isCdromCandidate(vmxDict, dev):
-                candidate = dev
+        for dev in devices:
+            if self.isCdromCandidate(vmx, dev):
+                return dev
 
-        return candidate
+        # All drives are in use, so take over the first one
+        if len(devices) > 0:
+            return devices[0]
+        return None
 
-    def isCdromDevice(self, vmxDict, device):
-        if not self.getBoolVmxKey(vmxDict, device + ".present"):
+    def isCdromDevice(self, vmx, device):
+        if not vmx.getBool(device + ".present"):
             return False
 
-        deviceType = self.getVmxKey(vmxDict, device + ".devicetype")
-        if deviceType not in ['"atapi-cdrom"', '"cdrom-raw"', '"cdrom-image"']:
-            return False
+        deviceType = vmx.get(device + ".deviceType").lower()
+        return deviceType in ["atapi-cdrom", "cdrom-raw", "cdrom-image"]
 
-        return True
-
-    def isCdromCandidate(self, vmxDict, dev):
-        startConnected = self.getBoolVmxKey(vmxDict, ".startconnected")
-        if not startConnected:
+    def isCdromCandidate(self, vmx, dev):
+        if not vmx.getBool(dev + ".startConnected"):
             return True
-        deviceType = self.getVmxKey(vmxDict, dev + ".devicetype")
-        filename = self.getVmxKey(vmxDict, dev + ".filename")
-        if deviceType == '"cdrom-image"':
-            return filename == ""
+        deviceType = vmx.get(dev + ".deviceType").lower()
+        if deviceType == "cdrom-image":
+            return vmx.get(dev + ".fileName") == ""
         return True
 
-    def isMoutingOvfEnvIso(self, vmxDict, dev):
-        deviceType = self.getVmxKey(vmxDict, dev + ".devicetype")
-        filename = self.getVmxKey(vmxDict, dev + "filename")
-        return deviceType == '"cdrom-image"' and filename == '"ovf-env.iso"'
+    def isMountingOvfEnvIso(self, vmx, dev):
+        deviceType = vmx.get(dev + ".deviceType").lower()
+        filename = vmx.get(dev + ".fileName")
+        return deviceType == "cdrom-image" and filename == "ovf-env.iso"
 
-    def patchVmxFile(self, vmxFile, ovfEnv, transport):
+    @classmethod
+    def readOvfEnvStamp(cls, hashFile):
+        """Returns (digest, transport, vmx stamp) of the last patch"""
+        try:
+            with open(hashFile, "r") as f:
+                fields = f.read().split()
+        except IOError:
+            fields = []
+        if len(fields) != 3:
+            return ("", "", "")
+        return tuple(fields)
+
+    def patchVmxFile(self, vmxFile, ovfEnv, transport, isoCache=None):
         (dirname, _) = os.path.split(vmxFile)
 
         transport = [s.lower() for s in transport]
@@ -279,82 +307,516 @@ class VmrunCommand(object):
         if not doIso and not doGuestInfo:
             doIso = doGuestInfo = True
 
-        dropKeys = set(["guestinfo.ovfenv",
-                        "msg.autoanswer"])
-        endBlock = ""
+        doc = ovfEnv.create_doc()
+        digest = hashlib.sha1(doc.encode("utf-8")).hexdigest()
+        transportKey = ",".join(sorted(transport)) or "-"
+
+        # ovf-env.hash records what the VM was last patched with, so an
+        # unchanged environment neither rebuilds the ISO nor rewrites
+        # the .vmx file
+        ovfEnvIsoFile = os.path.join(dirname, "ovf-env.iso")
+        hashFile = os.path.join(dirname, "ovf-env.hash")
+        stamp = self.readOvfEnvStamp(hashFile)
+        envCurrent = stamp[0] == digest and \
+            (not doIso or os.path.exists(ovfEnvIsoFile))
+        vmxCurrent = stamp[1:] == (transportKey, FileStamp(vmxFile))
+        if envCurrent and vmxCurrent:
+            return
+
+        vmx = VmxDocument(vmxFile)
 
         # Generate ISO
         if doIso:
-            ovfEnvIsoFile = os.path.join(dirname, "ovf-env.iso")
-            ovfEnv.create_iso(ovfEnvIsoFile)
+            if not envCurrent:
+                def build(isoFile):
+                    self.createIsoImage(isoFile, "OVF ENV",
+                                        {"ovf-env.xml": doc})
+
+                if isoCache is None:
+                    build(ovfEnvIsoFile)
+                else:
+                    isoCache.install(digest, ovfEnvIsoFile, build)
+
+                # Save ovf-env to be nice
+                ovfEnvFile = os.path.join(dirname, "ovf-env.xml")
+                WriteTxtFile(ovfEnvFile, doc)
 
             # Detect CD ROM device
-            device = self.detectCdRomDevice(vmxFile)
+            device = self.detectCdRomDevice(vmx)
             if device is None:
                 print("Error: No cdrom device found for OVF environment in VM",
                       vmxFile)
                 sys.exit(-1)
 
-            # Save ovf-env to be nice
-            ovfEnvFile = os.path.join(dirname, "ovf-env.xml")
-            WriteTxtFile(ovfEnvFile, ovfEnv.create_doc())
-
-            dropKeys.add(device + ".filename")
-            dropKeys.add(device + ".devicetype")
-            dropKeys.add(device + ".autodetect")
-            dropKeys.add(device + ".startconnected")
-            dropKeys.add(device + ".present")
-
-            endBlock += '''
-msg.autoAnswer = "TRUE"
-%s.fileName = "ovf-env.iso"
-%s.deviceType = "cdrom-image"
-%s.startConnected = "TRUE"
-%s.present = "TRUE"
-''' % (device, device, device, device)
+            vmx.set("msg.autoAnswer", "TRUE")
+            vmx.drop(device + ".autodetect")
+            vmx.setDevice(device, [("fileName", "ovf-env.iso"),
+                                   ("deviceType", "cdrom-image"),
+                                   ("startConnected", "TRUE"),
+                                   ("present", "TRUE")])
+        else:
+            vmx.drop("msg.autoAnswer")
 
         if doGuestInfo:
-            endBlock += '''
-guestinfo.ovfEnv = "%s"
-''' % (self.vmxEscape(ovfEnv.create_doc()))
+            vmx.set("guestinfo.ovfEnv", doc)
+        else:
+            vmx.drop("guestinfo.ovfEnv")
+
+        vmx.save()
 
-        self.rewriteVmxFile(vmxFile, dropKeys, endBlock)
+        AtomicWriteFile(hashFile, "%s %s %s\n" % (digest, transportKey,
+                                                  FileStamp(vmxFile)),
+                        syncDir=False)
 
     def disconnectOvfIsoInVmx(self, vmxFile, transports):
         # No need to unmount if we didn't mount it
-        transports = [string.lower(t) for t in transports]
+        transports = [t.lower() for t in transports]
         doIso = "iso" in transports
         if not doIso:
             return
 
         # Detect CD ROM device
-        device = self.detectCdRomDevice(vmxFile)
+        vmx = VmxDocument(vmxFile)
+        device = self.detectCdRomDevice(vmx)
         if device is None:
             return
 
-        dropKeys = set([device + "startconnected"])
-        endBlock = device + '.startConnected="FALSE"'
+        vmx.set(device + ".startConnected", "FALSE")
+        vmx.save()
+
 
-        self.rewriteVmxFile(vmxFile, dropKeys, endBlock)
+class VmrunCommand(HypervisorBackend):
+    """Backend driving VMware Workstation/Fusion through vmrun"""
 
-    def rewriteVmxFile(self, vmxFile, dropKeys, endBlock):
-        # Rewrite VMX file
-        newVmxFile = vmxFile + ".rewritten"
-        vmxIn = open(vmxFile, "r")
-        vmxOut = open(newVmxFile, "w")
-        for line in vmxIn:
-            line = line[:-1]
-            key, _ = self.splitVmxEntry(line)
-            if key in dropKeys:
+    def powerOn(self, vmxPath):
+        guiOption = "nogui"
+        if GetCmdOption("gui", False):
+            guiOption = "gui"
+        cmd = [VMRUN_CMD, "start", vmxPath, guiOption]
+        return self.subprocessCall(cmd)
+
+    def powerOff(self, vmxPath, hard=False, timeout=None):
+        if hard:
+            action = "hard"
+        else:
+            action = "soft"
+        cmd = [VMRUN_CMD, "stop", vmxPath, action]
+        return self.subprocessCall(cmd, timeout=timeout)
+
+    @classmethod
+    def subprocessCall(cls, cmd, exitOnFail=True, timeout=None):
+        try:
+            # On Windows, inhibit the console window that
+            # pops up as a result of doing this.
+            if sys.platform.startswith('win'):
+                import win32process
+                opts = {'creationflags': win32process.CREATE_NO_WINDOW}
+            else:
+                opts = {}
+            p = subprocess.Popen(cmd, **opts)
+        except Exception:
+            print("Error: Failed to execute ", cmd[0], ". Is it in your path?")
+            if exitOnFail:
+                sys.exit(1)
+            return False
+
+        timer = ProcessTimer(p, timeout)
+        p.wait()
+        timer.cancel()
+        return p.returncode == 0 and not timer.expired
+
+    @classmethod
+    def subprocessOutput(cls, cmd, timeout=None):
+        """Returns the output of cmd.
+
+        If timeout is given, cmd is killed when it has not finished
+        within timeout seconds, and None is returned.
+        """
+        # We pipe stdin even though we don't write anything to it,
+        # and use NUL_STDERR (on Windows, an explicit nul-pointing
+        # file handle.) This is to work around issues with py2exe
+        # and does not harm behavior on non-Windows platforms.
+        # Furthermore, on Windows, inhibit the console window that
+        # pops up as a result of doing this.
+        if sys.platform.startswith('win'):
+            import win32process
+            opts = {'creationflags': win32process.CREATE_NO_WINDOW}
+        else:
+            opts = {}
+
+        p = subprocess.Popen(cmd,
+                             stdout=subprocess.PIPE,
+                             stdin=subprocess.PIPE,
+                             stderr=NUL_STDERR,
+                             **opts)
+        timer = ProcessTimer(p, timeout)
+        out = p.stdout.read().decode('utf-8')
+        p.stdout.close()
+        p.wait()
+        timer.cancel()
+        if timer.expired:
+            return None
+        return out
+
+    @classmethod
+    def readRuntimeVariable(cls, vmxPath, name):
+        cmd = [VMRUN_CMD,
+               "readVariable",
+               vmxPath,
+               "runtimeConfig",
+               name]
+        out = cls.subprocessOutput(cmd)
+        return out.strip().lower()
+
+    def writeRuntimeVariable(self, vmxPath, name, value):
+        cmd = [VMRUN_CMD,
+               "writeVariable",
+               vmxPath,
+               "runtimeConfig",
+               name,
+               value]
+        return self.subprocessCall(cmd)
+
+    def listRunningVms(self):
+        try:
+            out = self.subprocessOutput([VMRUN_CMD, "list"])
+        except Exception:
+            return None
+
+        lines = [line.strip() for line in out.splitlines()
+                 if len(line.strip()) > 0]
+        if len(lines) == 0 or \
+           not lines[0].lower().startswith("total running vms"):
+            return None
+        return set([self.normalizeVmxPath(line) for line in lines[1:]])
+
+    def getPowerStatesAndIps(self, vmxPaths, withIp=True):
+        if GetEnvOption("POWER_PROBE", "vmrun") == "lockfile" and \
+           VmLockDetector.isSupported():
+            return self.getPowerStatesFromLocks(vmxPaths, withIp)
+        return HypervisorBackend.getPowerStatesAndIps(self, vmxPaths, withIp)
+
+    def waitForGuestIp(self, vmxPath, timeout):
+        # getGuestIPAddress -wait blocks until tools report an IP, so a
+        # single process replaces the polling. Older vmrun versions do
+        # not support it, which is handled by polling the remaining time.
+        start = time.time()
+        cmd = [VMRUN_CMD, "getGuestIPAddress", vmxPath, "-wait"]
+        out = self.subprocessOutput(cmd, timeout)
+        if out is not None:
+            ip = out.strip()
+            if len(ip) > 0 and ip.lower().find("error") == -1:
+                return ip
+
+        remaining = timeout - (time.time() - start)
+        if remaining <= 0:
+            return ""
+        return HypervisorBackend.waitForGuestIp(self, vmxPath, remaining)
+
+    def getPowerStatesFromLocks(self, vmxPaths, withIp=True):
+        """Like getPowerStatesAndIps, but without spawning vmrun.
+
+        vmrun is only used for VMs the lock files cannot classify, and
+        to read the guest IP of running VMs if withIp is set.
+        """
+        detector = VmLockDetector()
+        result = [(detector.getPowerState(p), "") for p in vmxPaths]
+        pending = [i for i, (state, _) in enumerate(result)
+                   if state is None or (withIp and state == "Powered On")]
+        states = ParallelMap(lambda i: self.getPowerStateAndIp(vmxPaths[i]),
+                             pending)
+        for i, state in zip(pending, states):
+            result[i] = state
+        return result
+
+    def createSparseVmdk(self, filename, diskSize):
+        OsTryRemove(filename)
+        cmd = [VDISKMANAGER_CMD,
+               "-c",
+               "-t", "0",              # monoSparse
+               "-s", diskSize + "GB",  # capacity
+               "-a", "lsilogic",       # adapter type
+               filename]
+
+        return self.subprocessCall(cmd, exitOnFail=False)
+
+
+class VmLockDetector(object):
+    """Classifies VMs from the files Workstation keeps for running VMs.
+
+    A powered on VM has a <vm>.vmx.lck directory next to its .vmx file
+    and its vmware.log is held open by a vmware-vmx process. This only
+    works on Linux, where open files can be found through /proc.
+    """
+
+    def __init__(self):
+        self.openFiles = None
+
+    @classmethod
+    def isSupported(cls):
+        return sys.platform.startswith("linux") and os.path.isdir("/proc")
+
+    def getOpenFiles(self):
+        if self.openFiles is not None:
+            return self.openFiles
+
+        self.openFiles = set()
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
                 continue
-            print(line, file=vmxOut)
+            try:
+                with open(os.path.join("/proc", pid, "comm")) as f:
+                    if not f.read().startswith("vmware-vmx"):
+                        continue
+                fdDir = os.path.join("/proc", pid, "fd")
+                for fd in os.listdir(fdDir):
+                    self.openFiles.add(os.readlink(os.path.join(fdDir, fd)))
+            except (IOError, OSError):
+                # Process is gone or belongs to another user
+                continue
+        return self.openFiles
+
+    def getPowerState(self, vmxPath):
+        """Returns the power state, or None if it cannot be decided"""
+        if not os.path.isdir(vmxPath + ".lck"):
+            return "Powered Off"
+
+        # The lock may be stale (crash) or held by a GUI that merely has
+        # the VM open, so only trust it together with an open log file.
+        logFile = os.path.join(os.path.dirname(os.path.realpath(vmxPath)),
+                               "vmware.log")
+        if logFile in self.getOpenFiles():
+            return "Powered On"
+        return None
+
+
+class OvfEnvIsoCache(object):
+    """Workspace wide store of OVF environment ISO images.
+
+    Images are named after the SHA-1 of the environment document they
+    hold, so a VM booting with an environment that was seen before gets
+    a hard link to the existing image. Only the maxEntries most recently
+    used images are kept (VAPPRUN_ISO_CACHE_SIZE, 0 disables the cache).
+    """
+
+    def __init__(self, dirname, maxEntries=None):
+        self.dir = dirname
+        if maxEntries is None:
+            maxEntries = int(GetEnvOption("ISO_CACHE_SIZE", 64))
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+
+    def install(self, digest, isoFile, build):
+        """Places the image for digest at isoFile.
+
+        build(fileName) creates the image and is only called on a miss.
+        """
+        if self.maxEntries <= 0:
+            build(isoFile)
+            return
+
+        cachedFile = os.path.join(self.dir, digest + ".iso")
+        with self.lock:
+            if os.path.exists(cachedFile):
+                os.utime(cachedFile, None)  # Most recently used
+            else:
+                OsMkdirs(self.dir)
+                tmpName = "%s.%d.tmp" % (cachedFile, os.getpid())
+                try:
+                    build(tmpName)
+                    OsReplace(tmpName, cachedFile)
+                except BaseException:
+                    OsTryRemove(tmpName)
+                    raise
+                self.prune()
+
+            try:
+                self.linkOrCopy(cachedFile, isoFile)
+            except (IOError, OSError):
+                # Another vapprun may just have evicted the image
+                build(isoFile)
+
+    @classmethod
+    def linkOrCopy(cls, src, dst):
+        tmpName = "%s.%d.tmp" % (dst, os.getpid())
+        OsTryRemove(tmpName)
+        try:
+            os.link(src, tmpName)
+        except (AttributeError, OSError):
+            shutil.copyfile(src, tmpName)
+        OsReplace(tmpName, dst)
+
+    def prune(self):
+        def lastUsed(fileName):
+            try:
+                return os.path.getmtime(fileName)
+            except OSError:
+                return 0
+
+        images = [os.path.join(self.dir, f) for f in os.listdir(self.dir)
+                  if f.endswith(".iso")]
+        if len(images) <= self.maxEntries:
+            return
+        images.sort(key=lastUsed)
+        for fileName in images[:len(images) - self.maxEntries]:
+            OsTryRemove(fileName)
+
+
+class VmxDocument(object):
+    """A .vmx file parsed once, edited in memory and written back once.
+
+    The lines are kept as they are, including their line endings, so
+    comments and formatting survive a rewrite and an unchanged document
+    is written back byte for byte. Keys are looked up case-insensitively.
+    """
+
+    # Order in which device buses are searched (e.g. for a CD-ROM)
+    BUSES = ["ide", "scsi", "sata"]
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.lines = []
+        self.index = {}  # Lowercased key -> line numbers
+        # Read without newline translation. Lines are split on "\n" only,
+        # so a "\r" of CRLF line endings stays at the end of its line.
+        with io.open(fileName, "r", encoding="utf-8", newline="") as f:
+            content = f.read()
+        self.digest = self.contentDigest(content)
+        lines = content.split("\n")
+        self.finalNewline = len(content) == 0 or content.endswith("\n")
+        if self.finalNewline:
+            lines.pop()
+        self.eol = ""  # Added to the lines appended by set()
+        if len(lines) > 0 and lines[0].endswith("\r"):
+            self.eol = "\r"
+        for line in lines:
+            self.addLine(line)
+
+    @classmethod
+    def escape(cls, s):
+        escaped = ['#', '|', '\\', '"']
 
-        print(endBlock, file=vmxOut)
+        def escapeChar(c):
+            if c in escaped or ord(c) < 32:
+                return "|%02x" % ord(c)
+            else:
+                return c
+
+        return "".join([escapeChar(c) for c in s])
 
-        vmxIn.close()
-        vmxOut.close()
+    @classmethod
+    def unescape(cls, s):
+        return re.sub(r"\|([0-9a-fA-F]{2})",
+                      lambda m: chr(int(m.group(1), 16)), s)
 
-        oldVmxFile = vmxFile + ".old"
+    @classmethod
+    def splitEntry(cls, line):
+        (key, sep, value) = line.partition("=")
+        if len(sep) == 0 or line.lstrip().startswith("#"):
+            return ("", "")
+        return (key.strip(), value.strip())
+
+    def addLine(self, line):
+        (key, _) = self.splitEntry(line)
+        if len(key) > 0:
+            self.index.setdefault(key.lower(), []).append(len(self.lines))
+        self.lines.append(line)
+
+    def appendLine(self, line):
+        if not self.finalNewline:
+            # The last line gets the line end it was missing
+            for n in range(len(self.lines) - 1, -1, -1):
+                if self.lines[n] is not None:
+                    if not self.lines[n].endswith(self.eol):
+                        self.lines[n] += self.eol
+                    break
+            self.finalNewline = True
+        self.addLine(line + self.eol)
+
+    def has(self, key):
+        return key.lower() in self.index
+
+    def get(self, key, default=""):
+        """Returns the unquoted value of the last entry for key"""
+        lines = self.index.get(key.lower())
+        if lines is None:
+            return default
+        (_, value) = self.splitEntry(self.lines[lines[-1]])
+        if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        return self.unescape(value)
+
+    def getBool(self, key, default=False):
+        if not self.has(key):
+            return default
+        return self.get(key).lower() == "true"
+
+    def set(self, key, value):
+        """Sets key, in place if it already exists"""
+        lines = self.index.get(key.lower())
+        if lines is None:
+            self.appendLine('%s = "%s"' % (key, self.escape(value)))
+            return
+
+        first = lines[0]
+        (oldKey, _) = self.splitEntry(self.lines[first])
+        eol = "\r" if self.lines[first].endswith("\r") else ""
+        self.lines[first] = '%s = "%s"%s' % (oldKey, self.escape(value), eol)
+        for n in lines[1:]:
+            self.lines[n] = None
+        self.index[key.lower()] = [first]
+
+    def drop(self, key):
+        for n in self.index.pop(key.lower(), []):
+            self.lines[n] = None
+
+    def setDevice(self, device, settings):
+        """Sets a list of (key, value) pairs for a device, e.g. ide1:0"""
+        for key, value in settings:
+            self.set(device + "." + key, value)
+
+    def devices(self):
+        """Returns the devices (e.g. "ide1:0") that have keys, ordered
+        by bus type, bus and unit number."""
+        patt = re.compile(r"^(%s)(\d+):(\d+)\." % "|".join(self.BUSES))
+        found = set()
+        for key in self.index:
+            m = patt.match(key)
+            if m is not None:
+                found.add((self.BUSES.index(m.group(1)),
+                           int(m.group(2)), int(m.group(3))))
+        return ["%s%d:%d" % (self.BUSES[bus], x, y)
+                for (bus, x, y) in sorted(found)]
+
+    def serialize(self):
+        lines = [line for line in self.lines if line is not None]
+        content = "\n".join(lines)
+        if self.finalNewline and len(lines) > 0:
+            content += "\n"
+        return content
+
+    @classmethod
+    def contentDigest(cls, content):
+        return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    def save(self):
+        """Writes the document back, unless nothing changed.
+
+        Returns True if the file was written.
+        """
+        content = self.serialize()
+        digest = self.contentDigest(content)
+        if digest == self.digest:
+            return False
+
+        # Keep the previous version around, as a hard link where possible
+        oldVmxFile = self.fileName + ".old"
         OsTryRemove(oldVmxFile)
-        os.rename(vmxFile, oldVmxFile)
-        os.rename(newVmxFile, vmxFile)
+        try:
+            os.link(self.fileName, oldVmxFile)
+        except (AttributeError, OSError):
+            shutil.copyfile(self.fileName, oldVmxFile)
+
+        AtomicWriteFile(self.fileName, content.encode("utf-8"))
+        self.digest = digest
+        return True